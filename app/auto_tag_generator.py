@@ -1,14 +1,24 @@
 # app/auto_tag_generator.py
 import os
 import json
+import hashlib
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List
 from dotenv import load_dotenv
-from app.tag_loader import load_masking_config, load_json_with_encoding
+from app.json_io import load_json_with_encoding, atomic_write_json, loads
+from app.tag_loader import load_masking_config
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Catalog sharding for large schemas: tables per LLM request and parallel requests
+TABLES_PER_SHARD = 30
+MAX_PARALLEL_SHARDS = 4
+
+# Shared HTTP session so repeated LLM calls reuse the pooled TCP/TLS connection
+_HTTP = requests.Session()
+
 def get_llm_credentials():
     """Get LLM API credentials from environment"""
     api_key = os.getenv("OPENAI_API_KEY", "").strip()
@@ -20,58 +30,39 @@ def get_llm_credentials():
     
     return api_key, model, endpoint
 
-def build_classification_prompt(catalog: Dict[str, Any], config: Dict[str, Any]) -> str:
-    """Build prompt for LLM to classify database fields into tags"""
-    
+def build_static_prompt(config: Dict[str, Any]) -> str:
+    """
+    Config-only part of the classification prompt (tag guide, rules, output format).
+    It is identical across runs and shards, so it goes first to hit provider prompt caching.
+    """
     tag_definitions = config.get("tag_definitions", {})
     
     # Build tag reference guide
-    tag_guide = "AVAILABLE TAGS AND THEIR MEANINGS:\n"
+    guide_parts: List[str] = ["AVAILABLE TAGS AND THEIR MEANINGS:\n"]
     for tag_name, tag_info in tag_definitions.items():
         description = tag_info.get("description", "")
         sensitivity = tag_info.get("sensitivity_level", 0)
         compliance = tag_info.get("compliance", [])
         
-        tag_guide += f"\n- **{tag_name}** (Sensitivity: {sensitivity})\n"
-        tag_guide += f"  Description: {description}\n"
+        guide_parts.append(f"\n- **{tag_name}** (Sensitivity: {sensitivity})\n")
+        guide_parts.append(f"  Description: {description}\n")
         if compliance:
-            tag_guide += f"  Compliance: {', '.join(compliance)}\n"
-    
-    # Build schema information
-    schema_info = "\nDATABASE SCHEMA TO CLASSIFY:\n"
-    for db_id, db_data in catalog.items():
-        schema_info += f"\n## Database: {db_id}\n"
-        
-        if not isinstance(db_data, dict) or "tables" not in db_data:
-            continue
-            
-        for table_fqn, table_data in db_data["tables"].items():
-            # Generate the full table path as DatabaseName.schema.table_name
-            schema_name = table_data.get("schema", "public")
-            table_name = table_data.get("name", table_fqn.split(".")[-1])
-            full_table_path = f"{db_id}.{schema_name}.{table_name}"
-            
-            schema_info += f"\n### Table: {full_table_path}\n"
-            schema_info += f"Business Context: {table_name} table in {db_id} database\n"
-            
-            for column in table_data.get("columns", []):
-                col_name = column.get("name", "")
-                col_type = column.get("type", "")
-                schema_info += f"- {col_name} ({col_type})\n"
+            guide_parts.append(f"  Compliance: {', '.join(compliance)}\n")
     
     # Build dynamic classification examples from config
-    classification_examples = ""
+    ex_parts: List[str] = []
     if tag_definitions:
-        classification_examples = "\nCLASSIFICATION GUIDANCE (based on your configuration):\n"
+        ex_parts.append("\nCLASSIFICATION GUIDANCE (based on your configuration):\n")
         for tag_name, tag_info in tag_definitions.items():
             examples = tag_info.get("examples", [])
             if examples:
                 example_text = ", ".join(examples)
-                classification_examples += f"- **{tag_name}**: {example_text}\n"
+                ex_parts.append(f"- **{tag_name}**: {example_text}\n")
+    classification_examples = "".join(ex_parts)
     
     # Classification instructions
     instructions = """
-TASK: Classify each database table and field with appropriate tags from the available tags above.
+TASK: Classify each database table and field in the schema below with appropriate tags from the available tags above.
 
 RULES:
 1. Use ONLY the tags defined above - do not invent new tags
@@ -97,17 +88,66 @@ OUTPUT FORMAT: Return ONLY a valid JSON object with this exact structure:
 }
 
 IMPORTANT: 
-- Use the EXACT table names as shown above (DatabaseName.schema.table_name)
+- Use the EXACT table names as shown in the schema (DatabaseName.schema.table_name)
 - Always include both table_tags and column_tags arrays
 - Empty arrays are acceptable if no tags apply
 - DO NOT include any markdown formatting, explanations, or text outside the JSON
 
 """
 
-    return tag_guide + schema_info + instructions
+    return "".join(guide_parts) + instructions
 
-def call_llm_for_classification(prompt: str) -> Dict[str, Any]:
-    """Call LLM API to classify database fields"""
+def build_schema_prompt(catalog: Dict[str, Any]) -> str:
+    """Catalog-dependent part of the classification prompt (the schema to classify)"""
+    schema_parts: List[str] = ["DATABASE SCHEMA TO CLASSIFY:\n"]
+    for db_id, db_data in catalog.items():
+        schema_parts.append(f"\n## Database: {db_id}\n")
+        
+        if not isinstance(db_data, dict) or "tables" not in db_data:
+            continue
+            
+        for table_fqn, table_data in db_data["tables"].items():
+            # Generate the full table path as DatabaseName.schema.table_name
+            schema_name = table_data.get("schema", "public")
+            table_name = table_data.get("name", table_fqn.split(".")[-1])
+            full_table_path = f"{db_id}.{schema_name}.{table_name}"
+            
+            schema_parts.append(f"\n### Table: {full_table_path}\n")
+            schema_parts.append(f"Business Context: {table_name} table in {db_id} database\n")
+            
+            for column in table_data.get("columns", []):
+                col_name = column.get("name", "")
+                col_type = column.get("type", "")
+                schema_parts.append(f"- {col_name} ({col_type})\n")
+    
+    return "".join(schema_parts)
+
+def shard_catalog(catalog: Dict[str, Any], tables_per_shard: int = TABLES_PER_SHARD) -> List[Dict[str, Any]]:
+    """Split a catalog into sub-catalogs of at most tables_per_shard tables each"""
+    shards: List[Dict[str, Any]] = []
+    current: Dict[str, Any] = {}
+    count = 0
+    for db_id, db_data in catalog.items():
+        if not isinstance(db_data, dict) or "tables" not in db_data:
+            continue
+        for table_fqn, table_data in db_data["tables"].items():
+            if count == tables_per_shard:
+                shards.append(current)
+                current, count = {}, 0
+            if db_id not in current:
+                current[db_id] = {**db_data, "tables": {}}
+            current[db_id]["tables"][table_fqn] = table_data
+            count += 1
+    if current:
+        shards.append(current)
+    return shards
+
+def call_llm_for_classification(prompt: str, schema_prompt: str = "") -> Dict[str, Any]:
+    """
+    Call LLM API to classify database fields.
+    When schema_prompt is given it is sent as a separate, trailing user message so the
+    static prompt stays a cacheable prefix.
+    """
     api_key, model, endpoint = get_llm_credentials()
     
     headers = {
@@ -115,32 +155,39 @@ def call_llm_for_classification(prompt: str) -> Dict[str, Any]:
         "Content-Type": "application/json",
     }
     
+    messages = [
+        {
+            "role": "system", 
+            "content": "You are a data classification expert. Analyze database schemas and assign appropriate sensitivity tags to fields based on their names, types, and business context. Always return valid JSON."
+        },
+        {
+            "role": "user", 
+            "content": prompt
+        }
+    ]
+    if schema_prompt:
+        messages.append({"role": "user", "content": schema_prompt})
+    
     payload = {
         "model": model,
         "response_format": {"type": "json_object"},
-        "messages": [
-            {
-                "role": "system", 
-                "content": "You are a data classification expert. Analyze database schemas and assign appropriate sensitivity tags to fields based on their names, types, and business context. Always return valid JSON."
-            },
-            {
-                "role": "user", 
-                "content": prompt
-            }
-        ],
+        "messages": messages,
         "temperature": 0.1,
         "max_tokens": 4000
     }
+    if schema_prompt and "api.openai.com" in endpoint:
+        # Route requests sharing the static prefix to the same prompt cache
+        payload["prompt_cache_key"] = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:32]
     
     print("LLM: Calling LLM for field classification...")
-    response = requests.post(endpoint, headers=headers, json=payload, timeout=60)
+    response = _HTTP.post(endpoint, headers=headers, json=payload, timeout=60)
     response.raise_for_status()
     
     data = response.json()
     content = data["choices"][0]["message"]["content"].strip()
     
     try:
-        return json.loads(content)
+        return loads(content)
     except json.JSONDecodeError as e:
         print(f"ERROR: LLM returned invalid JSON: {content}")
         raise ValueError(f"LLM returned invalid JSON: {e}")
@@ -148,21 +195,21 @@ def call_llm_for_classification(prompt: str) -> Dict[str, Any]:
 def validate_generated_mappings(mappings: Dict[str, Any], config: Dict[str, Any]) -> List[str]:
     """Validate that generated mappings use only defined tags"""
     errors = []
-    defined_tags = set(config.get("tag_definitions", {}).keys())
+    defined_tags = frozenset(config.get("tag_definitions", {}))
     
     table_mappings = mappings.get("table_mappings", {}) 
     
     for table_key, table_data in table_mappings.items():
         # Validate table tags
         table_tags = table_data.get("table_tags", [])
-        invalid_table_tags = set(table_tags) - defined_tags
+        invalid_table_tags = [t for t in table_tags if t not in defined_tags]
         if invalid_table_tags:
             errors.append(f"Table {table_key} has undefined table tags: {invalid_table_tags}")
         
         # Validate column tags
         column_tags = table_data.get("column_tags", {})
         for col_name, col_tags in column_tags.items():
-            invalid_col_tags = set(col_tags) - defined_tags
+            invalid_col_tags = [t for t in col_tags if t not in defined_tags]
             if invalid_col_tags:
                 errors.append(f"Column {table_key}.{col_name} has undefined tags: {invalid_col_tags}")
     
@@ -203,11 +250,23 @@ def auto_generate_field_tag_mappings(
     except Exception as e:
         raise RuntimeError(f"Failed to load input files: {e}")
     
-    # Build prompt and call LLM
-    prompt = build_classification_prompt(catalog, config)
+    # Build prompt (static config part first, schema last) and call LLM
+    static_prompt = build_static_prompt(config)
+    
+    # Large catalogs are classified in shards so each request stays well inside the context window
+    shards = shard_catalog(catalog)
+    schema_prompts = [build_schema_prompt(shard) for shard in shards] or [build_schema_prompt(catalog)]
     
     try:
-        generated_mappings = call_llm_for_classification(prompt)
+        if len(schema_prompts) == 1:
+            generated_mappings = call_llm_for_classification(static_prompt, schema_prompts[0])
+        else:
+            print(f"LLM: Classifying {len(schema_prompts)} catalog shards of up to {TABLES_PER_SHARD} tables")
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_SHARDS) as ex:
+                shard_results = list(ex.map(lambda sp: call_llm_for_classification(static_prompt, sp), schema_prompts))
+            generated_mappings = {"table_mappings": {}}
+            for shard_result in shard_results:
+                generated_mappings["table_mappings"].update(shard_result.get("table_mappings", {}))
     except Exception as e:
         raise RuntimeError(f"LLM classification failed: {e}")
     
@@ -220,8 +279,7 @@ def auto_generate_field_tag_mappings(
     
     # Save generated mappings
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(generated_mappings, f, indent=2, ensure_ascii=False)
+        atomic_write_json(output_file, generated_mappings)
         print(f"SUCCESS: Generated field tag mappings saved to: {output_file}")
     except Exception as e:
         raise RuntimeError(f"Failed to save mappings: {e}")
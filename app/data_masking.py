@@ -1,9 +1,29 @@
 # app/data_masking.py
+import numpy as np
 import pandas as pd
-import hashlib
 import re
-from typing import Dict, List, Any, Optional, Tuple
-from tag_loader import load_tag_mappings, load_masking_config, get_field_tags
+import sys
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Callable, Dict, List, Any, Optional, Tuple, FrozenSet
+from tag_loader import get_field_tags
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # pyarrow is optional; the pandas vector path is the fallback
+    pa = None
+    pc = None
+
+# Columns longer than this are masked with Arrow compute kernels when pyarrow is available
+ARROW_MASK_MIN_ROWS = 100_000
+
+# Value patterns used by star masking (compiled once, shared by scalar and vector paths).
+# The vector paths evaluate them on Arrow-backed strings with RE2, where \d is ASCII-only: a long
+# run of non-ASCII digits (e.g. Arabic-Indic) is masked as '****' there, but keeps its length
+# in anonymize_value.
+PHONE_RE = re.compile(r'^[\d\s\-\(\)\+\.]{7,}$')
+NUMERIC_RE = re.compile(r'^[\d.,\-]*\d[\d.,\-]*$')
 
 def anonymize_value(value: Any, method: str = "star_mask") -> Any:
     """Apply star masking to a value based on data type/length"""
@@ -18,33 +38,115 @@ def anonymize_value(value: Any, method: str = "star_mask") -> Any:
     
     # Star masking varies by data type/length
     if method == "star_mask" or True:  # Always use star masking now
+        length = len(str_value)
+        
         # Email pattern
         if '@' in str_value and '.' in str_value:
-            return '*' * len(str_value)
+            return '*' * length
         
         # Phone number pattern  
-        elif re.match(r'^[\d\s\-\(\)\+\.]+$', str_value) and len(str_value) >= 7:
-            return '*' * len(str_value)
+        elif PHONE_RE.match(str_value):
+            return '*' * length
         
         # Numeric values (financial, IDs, etc.)
-        elif str_value.replace('.', '').replace('-', '').replace(',', '').isdigit():
-            return '*' * len(str_value)
+        elif NUMERIC_RE.match(str_value):
+            return '*' * length
         
         # Short text (names, codes) - preserve length
-        elif len(str_value) <= 10:
-            return '*' * len(str_value)
+        elif length <= 10:
+            return '*' * length
         
         # Long text (descriptions, notes) - use fixed length stars
-        elif len(str_value) > 10:
-            return '****'
-        
-        # Default fallback
         else:
-            return '*' * min(len(str_value), 10)
+            return '****'
     
     # This shouldn't be reached, but keeping as fallback
     return '****'
 
+# Tag mappings currently backing _field_tags_cached, keyed by id()
+_TAG_MAPPINGS_REFS: Dict[int, Dict[str, Any]] = {}
+
+def _pin(refs: Dict[int, Any], obj: Any, *caches) -> int:
+    """
+    Return an identity key for obj, holding a reference so the id stays valid.
+    A different object (e.g. mappings reloaded from disk) clears the caches keyed on it.
+    """
+    key = id(obj)
+    if refs.get(key) is not obj:
+        refs.clear()
+        for cache in caches:
+            cache.cache_clear()
+        refs[key] = obj
+    return key
+
+@lru_cache(maxsize=100_000)
+def _field_tags_cached(db_id: str, table_name: str, column: str, mapping_key: int) -> FrozenSet[str]:
+    """Memoized get_field_tags against the pinned tag mappings"""
+    return get_field_tags(db_id, table_name, column, _TAG_MAPPINGS_REFS[mapping_key])
+
+# Masking config currently backing _sensitive_tags, keyed by id()
+_CONFIG_REFS: Dict[int, Dict[str, Any]] = {}
+
+@lru_cache(maxsize=128)
+def _sensitive_tags(role: str, config_key: int) -> FrozenSet[str]:
+    """Tags the role may not see in clear text (blocked or anonymized)"""
+    role_config = _CONFIG_REFS[config_key].get("roles", {}).get(role, {})
+    # Interned like the tag index's tags, so isdisjoint() matches them by identity
+    return frozenset(map(sys.intern, role_config.get("blocked_tags", []))) | frozenset(
+        map(sys.intern, role_config.get("anonymize_tags", []))
+    )
+
+def _length_stars(lens: np.ndarray, keep: np.ndarray) -> np.ndarray:
+    """'*' * lens[i] where keep[i], else '****'; one star string per distinct kept length"""
+    out = np.full(len(lens), "****", dtype=object)
+    if keep.any():
+        kept_lens, inverse = np.unique(lens[keep], return_inverse=True)
+        out[keep] = np.array(["*" * int(n) for n in kept_lens], dtype=object)[inverse]
+    return out
+
+def _arrow_star_mask(s: pd.Series) -> pd.Series:
+    """_vector_star_mask computed with Arrow compute kernels; only the star lookup touches Python objects"""
+    original = s.to_numpy(dtype=object)
+    text = pc.utf8_trim_whitespace(pa.array(s.astype("string"), type=pa.string()))
+    lens = pc.fill_null(pc.utf8_length(text), 0).to_numpy().astype("int64")
+    
+    keep = pc.or_kleene(
+        pc.or_kleene(
+            pc.and_kleene(pc.match_substring(text, "@"), pc.match_substring(text, ".")),
+            pc.match_substring_regex(text, PHONE_RE.pattern),
+        ),
+        pc.match_substring_regex(text, NUMERIC_RE.pattern),
+    )
+    keep = pc.fill_null(keep, False).to_numpy(zero_copy_only=False) | (lens <= 10)
+    
+    # Kept values get a star string of their length; everything else gets '****'
+    masked = _length_stars(lens, keep)
+    
+    # NaN/None and blank strings pass through untouched
+    passthrough = s.isna().to_numpy(dtype=bool) | (lens == 0)
+    return pd.Series(np.where(passthrough, original, masked), index=s.index, name=s.name, dtype=object)
+
+def _vector_star_mask(s: pd.Series) -> pd.Series:
+    """Vectorized equivalent of s.apply(anonymize_value) - same rules, no per-cell Python calls"""
+    if pc is not None and len(s) > ARROW_MASK_MIN_ROWS:
+        return _arrow_star_mask(s)
+    original = s.to_numpy(dtype=object)
+    text = s.astype("string").str.strip()
+    lens = text.str.len().fillna(0).astype("int64").to_numpy()
+    
+    # Category masks, evaluated once per column instead of once per cell
+    is_email = (text.str.contains("@", regex=False) & text.str.contains(".", regex=False)).fillna(False).to_numpy(dtype=bool)
+    is_phone = text.str.match(PHONE_RE).fillna(False).to_numpy(dtype=bool)
+    is_numeric = text.str.match(NUMERIC_RE).fillna(False).to_numpy(dtype=bool)
+    
+    # Emails, phones, numbers and short text keep their length; long text gets fixed stars
+    # Star strings are built only for the lengths that keep them, not for every length up to the longest cell
+    masked = _length_stars(lens, is_email | is_phone | is_numeric | (lens <= 10))
+    
+    # NaN/None and blank strings pass through untouched
+    passthrough = s.isna().to_numpy(dtype=bool) | (lens == 0)
+    return pd.Series(np.where(passthrough, original, masked), index=s.index, name=s.name, dtype=object)
+
 def check_role_access(role: str, field_tags: List[str], config: Dict[str, Any]) -> Tuple[bool, bool]:
     """
     Check if role has access to field with given tags
@@ -57,15 +159,9 @@ def check_role_access(role: str, field_tags: List[str], config: Dict[str, Any])
     if role not in roles:
         return True, True  # Unknown role = show column but mask data
     
-    role_config = roles[role]
-    blocked_tags = set(role_config.get("blocked_tags", []))
-    anonymize_tags = set(role_config.get("anonymize_tags", []))
-    
-    # Check if any field tag is sensitive (blocked OR anonymized)
-    field_tag_set = set(field_tags)
-    
     # If any field tag is in blocked OR anonymize list, mask with stars
-    if (field_tag_set & blocked_tags) or (field_tag_set & anonymize_tags):
+    sensitive_tags = _sensitive_tags(role, _pin(_CONFIG_REFS, config, _sensitive_tags, _role_summary))
+    if not sensitive_tags.isdisjoint(field_tags):
         return True, True  # Show column but mask data with stars
     
     # Otherwise, full access
@@ -88,23 +184,40 @@ def get_anonymization_method(field_tags: List[str], config: Dict[str, Any]) -> s
     # Default method
     return "redact"
 
+# Inverted column -> table index for infer_table_name_from_columns, keyed by id(tag_mappings)
+_COLUMN_INDEX_CACHE: Dict[int, Tuple[Dict[str, Any], Dict[str, List[int]], List[str]]] = {}
+
+def _column_index(tag_mappings: Dict[str, Any]) -> Tuple[Dict[str, List[int]], List[str]]:
+    """Return (column -> table positions, table keys), built once per mappings object"""
+    cached = _COLUMN_INDEX_CACHE.get(id(tag_mappings))
+    if cached is not None and cached[0] is tag_mappings:
+        return cached[1], cached[2]
+    
+    table_mappings = tag_mappings.get("table_mappings", {})
+    table_keys = list(table_mappings)
+    index: Dict[str, List[int]] = defaultdict(list)
+    for pos, table_data in enumerate(table_mappings.values()):
+        for column in table_data.get("column_tags", {}):
+            index[column].append(pos)
+    
+    _COLUMN_INDEX_CACHE.clear()
+    _COLUMN_INDEX_CACHE[id(tag_mappings)] = (tag_mappings, dict(index), table_keys)
+    return index, table_keys
+
 def infer_table_name_from_columns(columns: List[str], tag_mappings: Dict[str, Any]) -> Optional[str]:
     """Try to infer table name from column names - useful for final results"""
-    table_mappings = tag_mappings.get("table_mappings", {})
+    index, table_keys = _column_index(tag_mappings)
     
-    column_set = set(columns)
-    best_match = None
-    max_matches = 0
+    hits: Counter = Counter()
+    for column in dict.fromkeys(columns):
+        hits.update(index.get(column, ()))
     
-    for table_key, table_data in table_mappings.items():
-        table_columns = set(table_data.get("column_tags", {}).keys())
-        matches = len(column_set & table_columns)
-        
-        if matches > max_matches:
-            max_matches = matches
-            best_match = table_key
+    if not hits:
+        return None
     
-    return best_match
+    # Most matching columns wins; ties go to the table listed first
+    best_pos = min(hits, key=lambda pos: (-hits[pos], pos))
+    return table_keys[best_pos]
 
 def mask_dataframe_for_display(
     df: pd.DataFrame, 
@@ -118,14 +231,32 @@ def mask_dataframe_for_display(
     Apply role-based star masking to a pandas DataFrame for display
     All columns are kept visible, sensitive data is replaced with stars
     Returns: (masked_dataframe, masking_indicators)
+    When nothing needs masking the input frame itself is returned; treat the result as read-only.
     """
     if role == "admin":
-        return df.copy(), {}
+        return df, {}
     
     if df.empty:
-        return df.copy(), {}
+        return df, {}
     
-    # If table_name is not provided, try to infer it
+    db_id, table_name = _resolve_table(df, db_id, table_name, tag_mappings)
+    mapping_key = _pin(_TAG_MAPPINGS_REFS, tag_mappings, _field_tags_cached)
+    
+    # Find the sensitive columns first - most result sets have none
+    cols_to_mask = [
+        column for column in df.columns
+        if should_mask_field_with_stars(
+            role,
+            _field_tags_cached(db_id or "unknown", table_name or "unknown", column, mapping_key),
+            config
+        )
+    ]
+    return _star_mask_columns(df, cols_to_mask)
+
+def _resolve_table(
+    df: pd.DataFrame, db_id: str, table_name: Optional[str], tag_mappings: Dict[str, Any]
+) -> Tuple[str, Optional[str]]:
+    """(db_id, table_name), inferring the table from the frame's columns when it is not given"""
     if not table_name:
         inferred_table = infer_table_name_from_columns(df.columns.tolist(), tag_mappings)
         if inferred_table:
@@ -135,23 +266,60 @@ def mask_dataframe_for_display(
                 table_name = parts[-1]  # Get just the table name
                 if not db_id:
                     db_id = parts[0]  # Use inferred db_id if not provided
+    return db_id, table_name
+
+def _star_mask_columns(df: pd.DataFrame, cols_to_mask: List[str]) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    if not cols_to_mask:
+        return df, {}
     
-    masked_df = df.copy()
-    masking_indicators = {}
-    
-    # Process each column - keep all columns visible but mask sensitive values
-    for column in df.columns:
-        field_tags = get_field_tags(db_id or "unknown", table_name or "unknown", column, tag_mappings)
-        
-        if should_mask_field_with_stars(role, field_tags, config):
-            # Replace sensitive values with stars
-            masked_df[column] = masked_df[column].apply(lambda x: anonymize_value(x, "star_mask"))
-            masking_indicators[column] = "Masked"
+    # Keep all columns visible but replace sensitive values with stars; unmasked columns are not copied
+    masked_df = df.assign(**{column: _vector_star_mask(df[column]) for column in cols_to_mask})
+    masking_indicators = {column: "Masked" for column in cols_to_mask}
     
     return masked_df, masking_indicators
 
-def get_role_permissions_summary(role: str, config: Dict[str, Any]) -> Dict[str, Any]:
-    """Get a summary of what the role can access"""
+RoleMasker = Callable[..., Tuple[pd.DataFrame, Dict[str, str]]]
+
+def build_role_masker(role: str, tag_mappings: Dict[str, Any], config: Dict[str, Any]) -> RoleMasker:
+    """
+    mask_dataframe_for_display specialized for one role, tag mappings and config.
+    The role's sensitive tags are resolved once and each column's mask decision is remembered,
+    so repeated calls only do the masking itself.
+    Returns masker(df, db_id, table_name=None) -> (masked_dataframe, masking_indicators)
+    """
+    if role == "admin":
+        return lambda df, db_id, table_name=None: (df, {})
+    
+    # None: unknown role, every tagged column is masked
+    sensitive_tags: Optional[FrozenSet[str]] = None
+    if role in config.get("roles", {}):
+        sensitive_tags = _sensitive_tags(role, _pin(_CONFIG_REFS, config, _sensitive_tags, _role_summary))
+    decisions: Dict[Tuple[str, str, str], bool] = {}
+    
+    def masker(df: pd.DataFrame, db_id: str, table_name: Optional[str] = None) -> Tuple[pd.DataFrame, Dict[str, str]]:
+        if df.empty:
+            return df, {}
+        db_id, table_name = _resolve_table(df, db_id, table_name, tag_mappings)
+        db_id, table_name = db_id or "unknown", table_name or "unknown"
+        cols_to_mask = []
+        for column in df.columns:
+            key = (db_id, table_name, column)
+            masked = decisions.get(key)
+            if masked is None:
+                field_tags = get_field_tags(db_id, table_name, column, tag_mappings)
+                masked = decisions[key] = bool(field_tags) and (
+                    sensitive_tags is None or not sensitive_tags.isdisjoint(field_tags)
+                )
+            if masked:
+                cols_to_mask.append(column)
+        return _star_mask_columns(df, cols_to_mask)
+    
+    return masker
+
+@lru_cache(maxsize=64)
+def _role_summary(role: str, config_key: int) -> Dict[str, Any]:
+    """Memoized body of get_role_permissions_summary against the pinned config"""
+    config = _CONFIG_REFS[config_key]
     roles = config.get("roles", {})
     if role not in roles:
         return {"error": f"Role '{role}' not found"}
@@ -182,6 +350,11 @@ def get_role_permissions_summary(role: str, config: Dict[str, Any]) -> Dict[str,
         "allowed_exceptions": role_config.get("allowed_exceptions", [])
     }
 
+def get_role_permissions_summary(role: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Get a summary of what the role can access"""
+    # Shallow copy so callers can't alter the cached entry's keys
+    return dict(_role_summary(role, _pin(_CONFIG_REFS, config, _sensitive_tags, _role_summary)))
+
 
 def get_masking_summary(
     original_columns: List[str],
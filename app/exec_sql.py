@@ -1,22 +1,50 @@
 # app/exec_sql.py
+import re
+from functools import lru_cache
 from typing import Dict, Any, List, Optional
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.exc import SQLAlchemyError
 
+@lru_cache(maxsize=32)
 def _mk_engine(dsn: str) -> Engine:
-    return create_engine(dsn, pool_pre_ping=True, future=True)
+    """One pooled Engine per DSN, reused across calls"""
+    url = make_url(dsn)
+    # Pool sizing only applies to QueuePool dialects; SingletonThreadPool/StaticPool (e.g. SQLite) reject it
+    pool_args = {}
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        pool_args = {"pool_size": 5, "max_overflow": 10}
+    return create_engine(url, pool_pre_ping=True, future=True, **pool_args)
 
-def exec_sql(dsn: str, sql: str) -> Dict[str, Any]:
-    """Run a single SQL text on a DSN. Return {columns:[...], rows:[{...}], error:Optional[str]}"""
+_SELECT_RE = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+
+def wrap_with_limit(sql: str, row_limit: int) -> Optional[str]:
+    """Wrap a SELECT/WITH statement in an outer LIMIT; None if the statement can't be wrapped"""
+    body = sql.strip().rstrip(";").rstrip()
+    if not _SELECT_RE.match(body) or ";" in body:
+        return None
+    return f"SELECT * FROM (\n{body}\n) AS __q LIMIT {int(row_limit)}"
+
+def exec_sql(dsn: str, sql: str, row_limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Run a single SQL text on a DSN. Return {columns:[...], data:{column:[...]}, error:Optional[str]}
+    With row_limit, at most that many rows are fetched (outer LIMIT for SELECTs, fetchmany otherwise).
+    """
     try:
         eng = _mk_engine(dsn)
         with eng.connect() as cx:
-            rs = cx.execute(text(sql))
-            cols = [c if isinstance(c, str) else str(c) for c in rs.keys()]
-            out_rows: List[Dict[str, Any]] = []
-            for r in rs.mappings():
-                out_rows.append(dict(r))
-            return {"columns": cols, "rows": out_rows, "error": None}
+            if row_limit is not None:
+                limited = wrap_with_limit(sql, row_limit)
+                rs = cx.execute(text(limited if limited else sql))
+                cols = [c if isinstance(c, str) else str(c) for c in rs.keys()]
+                rows = rs.fetchmany(int(row_limit))
+            else:
+                rs = cx.execute(text(sql))
+                cols = [c if isinstance(c, str) else str(c) for c in rs.keys()]
+                rows = rs.fetchall()
+            # Column-oriented so callers can build a DataFrame without per-row dicts
+            data: Dict[str, List[Any]] = {col: [r[i] for r in rows] for i, col in enumerate(cols)}
+            return {"columns": cols, "data": data, "error": None}
     except SQLAlchemyError as e:
-        return {"columns": [], "rows": [], "error": str(e)}
+        return {"columns": [], "data": {}, "error": str(e)}
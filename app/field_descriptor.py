@@ -2,25 +2,65 @@
 """
 Field descriptor - AI-powered field description generation for database catalogs
 """
+import hashlib
 import json
 import os
 import requests
-from typing import Dict, Any, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.json_io import load_json_with_encoding, atomic_write_json, loads
+from app.llm_cache import LLMCache, request_key
+from app.llm_client import batch_complete, count_tokens
 
-def load_json_with_encoding(file_path: str) -> Dict[str, Any]:
-    """Load JSON file with multiple encoding attempts"""
-    p = Path(file_path)
-    if not p.exists():
-        raise FileNotFoundError(f"File not found: {file_path}")
-    
-    data = p.read_bytes()
-    for enc in ("utf-8", "utf-8-sig", "utf-16", "utf-16-le", "utf-16-be"):
-        try:
-            return json.loads(data.decode(enc))
-        except Exception:
-            continue
-    raise ValueError(f"Failed to parse JSON '{file_path}'.")
+# Upper bound on concurrent LLM requests (one request per prompt shard)
+MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+
+# Prompt token budget: model context minus the response (max_tokens) and some headroom
+CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS", "128000"))
+RESPONSE_TOKENS = 4000
+PROMPT_TOKEN_BUDGET = CONTEXT_TOKENS - RESPONSE_TOKENS - 512
+
+# Unique column name/type patterns described per LLM request, and example tables listed per pattern
+PATTERNS_PER_PROMPT = 40
+PATTERN_TABLE_HINTS = 5
+
+# (db_id, schema, table_name, column_name)
+FieldKey = Tuple[str, str, str, str]
+
+# Sidecar file (next to the catalog) remembering generated descriptions across runs
+DESCRIPTION_CACHE_NAME = "field_descriptions.cache.json"
+
+# Raw LLM responses keyed by request hash, so identical prompts (e.g. forced re-runs) cost nothing
+_RESPONSE_CACHE = LLMCache()
+
+# Shared keep-alive session: pooled connections are reused across the per-table requests
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def _get_session() -> requests.Session:
+    """Create the pooled, retrying HTTP session on first use"""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            # POST is retried too: a rate-limited (429) or failed completion request has no side effects
+            retry = Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["POST"],
+                respect_retry_after_header=True,
+            )
+            # Enough pooled connections per host for every concurrent request to keep its own alive
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(32, MAX_CONCURRENCY), max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+        return _SESSION
 
 def get_llm_credentials():
     """Get LLM API credentials from environment"""
@@ -33,49 +73,107 @@ def get_llm_credentials():
     
     return api_key, model, endpoint
 
-def build_description_prompt(catalog: Dict[str, Any]) -> str:
-    """Build prompt for AI to generate field descriptions"""
-    prompt = """You are a database field description expert. Analyze the following database schema and generate concise, professional descriptions for each field.
+def field_digest(db_id: str, schema: str, table_name: str, col_name: str, col_type: str) -> str:
+    """Cache key for a column; a type change invalidates its cached description"""
+    return hashlib.sha1(f"{db_id}|{schema}|{table_name}|{col_name}|{col_type}".encode("utf-8")).hexdigest()
 
-For each field, provide a brief description that explains:
+def _valid_dbs(catalog: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """(db_id, db_data) for catalog entries that have tables; error/non-dict entries are skipped"""
+    return [(db_id, db_data) for db_id, db_data in catalog.items() if isinstance(db_data, dict) and "tables" in db_data]
+
+def _iter_tables(catalog: Dict[str, Any]):
+    """Yield (db_id, schema, table_name, columns) for every table in the catalog"""
+    for db_id, db_data in _valid_dbs(catalog):
+        for table_fqn, table_data in db_data["tables"].items():
+            tget = table_data.get
+            yield db_id, tget("schema", "public"), tget("name", table_fqn.split(".")[-1]), tget("columns", [])
+
+def _iter_columns(catalog: Dict[str, Any]):
+    """Yield (db_id, schema, table_name, column) for every column in the catalog"""
+    for db_id, schema, table_name, columns in _iter_tables(catalog):
+        for column in columns:
+            yield db_id, schema, table_name, column
+
+def hydrate_descriptions_from_cache(catalog: Dict[str, Any], cache: Dict[str, str]) -> int:
+    """Fill missing column descriptions from the cache in place; returns how many were filled"""
+    filled = 0
+    for db_id, schema, table_name, column in _iter_columns(catalog):
+        if column.get("description"):
+            continue
+        cached = cache.get(field_digest(db_id, schema, table_name, column.get("name", ""), column.get("type", "")))
+        if cached:
+            column["description"] = cached
+            filled += 1
+    return filled
+
+def undescribed_catalog(catalog: Dict[str, Any]) -> Dict[str, Any]:
+    """Sub-catalog holding only columns without a description (tables with none are dropped)"""
+    pending: Dict[str, Any] = {}
+    for db_id, db_data in _valid_dbs(catalog):
+        tables = {}
+        for table_fqn, table_data in db_data["tables"].items():
+            columns = [c for c in table_data.get("columns", []) if not c.get("description")]
+            if columns:
+                tables[table_fqn] = {**table_data, "columns": columns}
+        if tables:
+            pending[db_id] = {**db_data, "tables": tables}
+    return pending
+
+def group_column_patterns(catalog: Dict[str, Any]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """
+    Bucket columns by (lower-cased name, type); each bucket lists the tables and
+    (db_id, schema, table, column) field keys sharing it
+    """
+    patterns: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for db_id, schema, table_name, columns in _iter_tables(catalog):
+        table_path = f"{db_id}.{schema}.{table_name}"
+        for column in columns:
+            cget = column.get
+            col_name = cget("name", "")
+            col_type = cget("type", "")
+            bucket = patterns.setdefault(
+                (col_name.lower(), col_type),
+                {"name": col_name, "type": col_type, "tables": [], "field_keys": []}
+            )
+            bucket["tables"].append(table_path)
+            bucket["field_keys"].append((db_id, schema, table_name, col_name))
+    return patterns
+
+def _pattern_line(pattern_id: str, bucket: Dict[str, Any]) -> str:
+    """Prompt line for one column pattern"""
+    tables = bucket["tables"]
+    hint = ", ".join(tables[:PATTERN_TABLE_HINTS])
+    if len(tables) > PATTERN_TABLE_HINTS:
+        hint += f" (+{len(tables) - PATTERN_TABLE_HINTS} more)"
+    return f"  [{pattern_id}] {bucket['name']} ({bucket['type']}) - appears in: {hint}\n"
+
+def build_pattern_prompt(patterns: List[Tuple[str, Dict[str, Any]]]) -> str:
+    """Build a prompt describing each column name/type pattern once, keyed by pattern id"""
+    parts: List[str] = ["""You are a database field description expert. Each entry below is a column name and type that may occur in several tables. Generate one concise, professional description per entry that fits every table it appears in.
+
+For each entry, provide a brief description that explains:
 - What the field represents
 - Its business purpose or meaning
-- Any relevant context from field names and table relationships
+- Any relevant context from the field name and the tables it appears in
 
 Keep descriptions concise (1-2 sentences max) and professional.
 
-Database Schema:
-"""
-    
-    for db_id, db_data in catalog.items():
-        if not isinstance(db_data, dict) or "tables" not in db_data:
-            continue
-            
-        prompt += f"\nDatabase: {db_id}\n"
-        
-        for table_fqn, table_data in db_data["tables"].items():
-            table_name = table_data.get("name", table_fqn.split(".")[-1])
-            schema = table_data.get("schema", "public")
-            
-            prompt += f"  Table: {schema}.{table_name}\n"
-            prompt += f"  Business Context: {table_name} table in {db_id} database\n"
-            
-            for column in table_data.get("columns", []):
-                col_name = column.get("name", "")
-                col_type = column.get("type", "")
-                prompt += f"    - {col_name} ({col_type})\n"
+Column Patterns:
+"""]
+    for pattern_id, bucket in patterns:
+        parts.append(_pattern_line(pattern_id, bucket))
     
-    prompt += """
+    parts.append("""
 Output format (JSON):
 {
-  "field_descriptions": {
-    "database.schema.table.column": "Description text",
+  "pattern_descriptions": {
+    "p1": "Description text",
     ...
   }
 }
 
 Guidelines:
-- Use format: "database_id.schema.table_name.column_name": "description"
+- Use the pattern id shown in brackets as the key
 - Keep descriptions professional and concise
 - Focus on business meaning, not technical implementation
 - For ID fields, mention what they identify
@@ -83,26 +181,57 @@ Guidelines:
 - For status/code fields, mention they represent categories or states
 - For amount/quantity fields, mention the business context
 
-Only return the JSON, no other text."""
+Only return the JSON, no other text.""")
 
-    return prompt
+    return "".join(parts)
 
-def call_llm_for_descriptions(prompt: str) -> Dict[str, Any]:
-    """Call LLM API to generate field descriptions"""
-    api_key, model, endpoint = get_llm_credentials()
+def build_description_requests(catalog: Dict[str, Any]) -> Tuple[List[str], Dict[str, List[FieldKey]]]:
+    """
+    Prompts covering every unique column pattern in the catalog, at most PATTERNS_PER_PROMPT
+    patterns and PROMPT_TOKEN_BUDGET tokens each.
+    Returns (prompts, pattern_id -> field keys) so answers can be fanned back out to every field.
+    """
+    buckets = list(group_column_patterns(catalog).values())
+    numbered = [(f"p{i}", bucket) for i, bucket in enumerate(buckets, 1)]
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+    # Shard by count and by estimated prompt tokens so no request overflows the context window
+    model = os.getenv("OPENAI_MODEL", "gpt-4o").strip()
+    budget = PROMPT_TOKEN_BUDGET - count_tokens(build_pattern_prompt([]), model)
+    shards: List[List[Tuple[str, Dict[str, Any]]]] = []
+    current: List[Tuple[str, Dict[str, Any]]] = []
+    current_tokens = 0
+    for pattern_id, bucket in numbered:
+        line_tokens = count_tokens(_pattern_line(pattern_id, bucket), model)
+        if current and (len(current) == PATTERNS_PER_PROMPT or current_tokens + line_tokens > budget):
+            shards.append(current)
+            current, current_tokens = [], 0
+        current.append((pattern_id, bucket))
+        current_tokens += line_tokens
+    if current:
+        shards.append(current)
     
-    payload = {
+    prompts = [build_pattern_prompt(shard) for shard in shards]
+    return prompts, {pattern_id: bucket["field_keys"] for pattern_id, bucket in numbered}
+
+def call_llm_batch(prompts: List[str], use_cache: bool = True) -> List[Dict[str, Any]]:
+    """Run call_llm_for_descriptions for every prompt concurrently; results keep prompt order"""
+    if not prompts:
+        return []
+    print(f"Calling LLM for field descriptions ({len(prompts)} requests, up to {MAX_CONCURRENCY} in parallel)...")
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENCY, len(prompts)))) as ex:
+        return list(ex.map(lambda prompt: call_llm_for_descriptions(prompt, use_cache), prompts))
+
+SYSTEM_PROMPT = "You are a database documentation expert. Generate concise, professional field descriptions that explain the business purpose and meaning of database columns. Always return valid JSON."
+
+def _description_payload(model: str, prompt: str) -> Dict[str, Any]:
+    """Chat completions request body for one description prompt"""
+    return {
         "model": model,
         "response_format": {"type": "json_object"},
         "messages": [
             {
                 "role": "system", 
-                "content": "You are a database documentation expert. Generate concise, professional field descriptions that explain the business purpose and meaning of database columns. Always return valid JSON."
+                "content": SYSTEM_PROMPT
             },
             {
                 "role": "user", 
@@ -110,26 +239,70 @@ def call_llm_for_descriptions(prompt: str) -> Dict[str, Any]:
             }
         ],
         "temperature": 0.1,
-        "max_tokens": 4000
+        "max_tokens": RESPONSE_TOKENS
+    }
+
+def _parse_description_content(content: str) -> Dict[str, Any]:
+    """Parse the JSON object returned in a completion message"""
+    try:
+        return loads(content)
+    except json.JSONDecodeError as e:
+        print(f"❌ LLM returned invalid JSON: {content}")
+        raise ValueError(f"LLM returned invalid JSON: {e}")
+
+def call_llm_for_descriptions(prompt: str, use_cache: bool = True) -> Dict[str, Any]:
+    """Call LLM API to generate field descriptions (answered from the response cache when possible)"""
+    api_key, model, endpoint = get_llm_credentials()
+    
+    cache_key = request_key(model, SYSTEM_PROMPT, prompt)
+    if use_cache:
+        cached = _RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            return _parse_description_content(cached)
+    
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
     }
     
-    print("Calling LLM for field descriptions...")
-    response = requests.post(endpoint, headers=headers, json=payload, timeout=60)
+    payload = _description_payload(model, prompt)
+    
+    response = _get_session().post(endpoint, headers=headers, json=payload, timeout=(10, 60))
     response.raise_for_status()
     
     data = response.json()
     content = data["choices"][0]["message"]["content"].strip()
     
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError as e:
-        print(f"❌ LLM returned invalid JSON: {content}")
-        raise ValueError(f"LLM returned invalid JSON: {e}")
+    result = _parse_description_content(content)
+    if use_cache:
+        _RESPONSE_CACHE.set(cache_key, content)
+    return result
+
+def call_llm_batch_api(prompts: List[str], poll_interval: float = 30.0) -> List[Dict[str, Any]]:
+    """
+    Run the prompts through the OpenAI Batch API (cheaper, completes within 24h) and wait for the results.
+    Results keep prompt order; a prompt whose request failed yields {} so its fields stay pending for the next run.
+    """
+    if not prompts:
+        return []
+    api_key, model, endpoint = get_llm_credentials()
+    contents = batch_complete(
+        _get_session(),
+        endpoint,
+        api_key,
+        [_description_payload(model, prompt) for prompt in prompts],
+        file_name="field_descriptions.jsonl",
+        poll_interval=poll_interval,
+        verbose=True,
+    )
+    return [_parse_description_content(content.strip()) if content is not None else {} for content in contents]
 
 def add_field_descriptions_to_catalog(
     catalog_file: str = "data/catalog_live.json",
     output_file: str = None,
-    force_regenerate: bool = False
+    force_regenerate: bool = False,
+    use_cache: bool = True,
+    use_batch_api: bool = False
 ) -> Dict[str, Any]:
     """
     Add AI-generated field descriptions to catalog
@@ -138,6 +311,9 @@ def add_field_descriptions_to_catalog(
         catalog_file: Path to input catalog file
         output_file: Path to output catalog file (defaults to same as input)
         force_regenerate: If True, regenerate descriptions even if they exist
+        use_cache: If True, reuse/record descriptions in the field_descriptions.cache.json sidecar
+            and identical LLM responses in the response cache
+        use_batch_api: If True, submit the prompts as an OpenAI batch job and wait for it (slower, cheaper)
     
     Returns:
         Enhanced catalog with descriptions
@@ -154,26 +330,36 @@ def add_field_descriptions_to_catalog(
     except Exception as e:
         raise RuntimeError(f"Failed to load catalog: {e}")
     
-    # Check if descriptions already exist and we're not forcing regeneration
-    if not force_regenerate:
-        has_descriptions = any(
-            column.get("description") 
-            for db_data in catalog.values() 
-            if isinstance(db_data, dict) and "tables" in db_data
-            for table_data in db_data["tables"].values()
-            for column in table_data.get("columns", [])
-        )
-        
-        if has_descriptions:
-            print("📝 Catalog already has field descriptions. Use force_regenerate=True to overwrite.")
+    cache_path = Path(catalog_file).with_name(DESCRIPTION_CACHE_NAME)
+    cache: Dict[str, str] = {}
+    if use_cache and cache_path.exists():
+        try:
+            cache = load_json_with_encoding(str(cache_path))
+        except Exception as e:
+            print(f"Ignoring unreadable description cache {cache_path}: {e}")
+    
+    # Only fields without a description are sent to the LLM unless regeneration is forced
+    if force_regenerate:
+        pending = catalog
+        reused = 0
+    else:
+        reused = hydrate_descriptions_from_cache(catalog, cache)
+        pending = undescribed_catalog(catalog)
+        if not pending and not reused:
+            print("📝 All catalog fields already have descriptions. Use force_regenerate=True to overwrite.")
             return catalog
     
-    # Generate descriptions
-    prompt = build_description_prompt(catalog)
+    # Describe each unique column name/type once, then fan the answer out to every matching field
+    prompts, pattern_fields = build_description_requests(pending)
+    print(f"Describing {len(pattern_fields)} unique column patterns for {sum(map(len, pattern_fields.values()))} fields")
     
     try:
-        result = call_llm_for_descriptions(prompt)
-        field_descriptions = result.get("field_descriptions", {})
+        field_descriptions: Dict[FieldKey, str] = {}
+        results = call_llm_batch_api(prompts) if use_batch_api else call_llm_batch(prompts, use_cache)
+        for result in results:
+            for pattern_id, description in result.get("pattern_descriptions", {}).items():
+                for field_key in pattern_fields.get(pattern_id, []):
+                    field_descriptions[field_key] = description
     except Exception as e:
         raise RuntimeError(f"Field description generation failed: {e}")
     
@@ -182,70 +368,60 @@ def add_field_descriptions_to_catalog(
     
     # Save enhanced catalog
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(enhanced_catalog, f, indent=2, ensure_ascii=False)
+        atomic_write_json(output_file, enhanced_catalog)
         print(f"Enhanced catalog with descriptions saved to: {output_file}")
     except Exception as e:
         raise RuntimeError(f"Failed to save enhanced catalog: {e}")
     
-    # Show summary
+    # One pass: count coverage and remember every described field for the next run
     desc_count = len(field_descriptions)
-    total_fields = sum(
-        len(table_data.get("columns", []))
-        for db_data in catalog.values()
-        if isinstance(db_data, dict) and "tables" in db_data
-        for table_data in db_data["tables"].values()
-    )
+    total_fields = 0
+    described_fields = 0
+    for db_id, schema, table_name, column in _iter_columns(enhanced_catalog):
+        total_fields += 1
+        description = column.get("description")
+        if description:
+            described_fields += 1
+            if use_cache:
+                cache[field_digest(db_id, schema, table_name, column.get("name", ""), column.get("type", ""))] = description
     
+    if use_cache:
+        try:
+            atomic_write_json(cache_path, cache)
+        except Exception as e:
+            print(f"Could not update description cache {cache_path}: {e}")
+    
+    # Show summary
     print(f"Description Summary:")
     print(f"   - Descriptions generated: {desc_count}")
+    print(f"   - Reused from cache: {reused}")
     print(f"   - Total fields: {total_fields}")
-    print(f"   - Coverage: {(desc_count/total_fields)*100:.1f}%" if total_fields > 0 else "   - Coverage: 0%")
+    print(f"   - Coverage: {(described_fields/total_fields)*100:.1f}%" if total_fields > 0 else "   - Coverage: 0%")
     
     return enhanced_catalog
 
-def add_descriptions_to_catalog_structure(catalog: Dict[str, Any], field_descriptions: Dict[str, str]) -> Dict[str, Any]:
-    """Add field descriptions to catalog structure"""
-    enhanced_catalog = {}
-    
-    for db_id, db_data in catalog.items():
-        if not isinstance(db_data, dict):
-            enhanced_catalog[db_id] = db_data
-            continue
-            
-        enhanced_db = dict(db_data)
-        
-        if "tables" not in db_data:
-            enhanced_catalog[db_id] = enhanced_db
-            continue
-            
-        enhanced_tables = {}
-        
-        for table_fqn, table_data in db_data["tables"].items():
-            enhanced_table = dict(table_data)
-            table_name = table_data.get("name", table_fqn.split(".")[-1])
-            schema = table_data.get("schema", "public")
-            
-            # Add descriptions to columns
-            enhanced_columns = []
-            for column in table_data.get("columns", []):
-                enhanced_column = dict(column)
-                col_name = column.get("name", "")
-                
-                # Look for field description
-                field_key = f"{db_id}.{schema}.{table_name}.{col_name}"
-                if field_key in field_descriptions:
-                    enhanced_column["description"] = field_descriptions[field_key]
-                
-                enhanced_columns.append(enhanced_column)
-            
-            enhanced_table["columns"] = enhanced_columns
-            enhanced_tables[table_fqn] = enhanced_table
-        
-        enhanced_db["tables"] = enhanced_tables
-        enhanced_catalog[db_id] = enhanced_db
+def parse_field_key(key: str) -> FieldKey:
+    """Turn a "database.schema.table.column" key (as returned by the LLM) into a FieldKey"""
+    db_id, schema, table_name, col_name = key.split(".", 3)
+    return db_id, schema, table_name, col_name
+
+def add_descriptions_to_catalog_structure(catalog: Dict[str, Any], field_descriptions: Dict[Any, str]) -> Dict[str, Any]:
+    """
+    Add field descriptions to catalog structure (in place; the same catalog is returned).
+    Keys are FieldKey tuples or "database.schema.table.column" strings.
+    """
+    field_descriptions = {
+        parse_field_key(key) if isinstance(key, str) else key: description
+        for key, description in field_descriptions.items()
+    }
+    for db_id, schema, table_name, columns in _iter_tables(catalog):
+        # Add descriptions to columns
+        for column in columns:
+            description = field_descriptions.get((db_id, schema, table_name, column.get("name", "")))
+            if description is not None:
+                column["description"] = description
     
-    return enhanced_catalog
+    return catalog
 
 def main():
     """Command line interface for field description generation"""
@@ -255,6 +431,8 @@ def main():
     parser.add_argument("--catalog", default="data/catalog_live.json", help="Catalog file path")
     parser.add_argument("--output", help="Output file path (defaults to same as input)")
     parser.add_argument("--force", action="store_true", help="Force regeneration of descriptions")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or update the description and LLM response caches")
+    parser.add_argument("--batch", action="store_true", help="Use the OpenAI Batch API (up to 24h, lower cost)")
     
     args = parser.parse_args()
     
@@ -262,7 +440,9 @@ def main():
         enhanced_catalog = add_field_descriptions_to_catalog(
             catalog_file=args.catalog,
             output_file=args.output,
-            force_regenerate=args.force
+            force_regenerate=args.force,
+            use_cache=not args.no_cache,
+            use_batch_api=args.batch
         )
         print("🎉 Field description generation completed successfully!")
         return enhanced_catalog
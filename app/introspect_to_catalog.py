@@ -1,8 +1,9 @@
 # introspect_to_catalog.py
 
-import json, sys, os
+import sys, os
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine, text
-from app.tag_loader import load_masking_config, load_json_with_encoding
+from app.json_io import load_json_with_encoding, atomic_write_bytes, dump_json_bytes, loads
 
 from dotenv import load_dotenv
 
@@ -11,40 +12,54 @@ load_dotenv()
 DSNS_FILE = "dsns.json"
 
 def list_tables_cols(engine):
+    # Columns are grouped per table in the database, one row per table
     q = text("""
-        select table_schema, table_name, column_name, data_type
+        select table_schema, table_name,
+               json_agg(json_build_object('name', column_name, 'type', data_type)
+                        order by ordinal_position) as cols
         from information_schema.columns
         where table_schema not in ('pg_catalog','information_schema')
-        order by table_schema, table_name, ordinal_position
+        group by table_schema, table_name
+        order by table_schema, table_name
     """)
     out = {}
-    with engine.connect() as c:
-        for sch, tbl, col, typ in c.execute(q):
-            dbtbl = f"{sch}.{tbl}"
-            t = out.setdefault(dbtbl, {"schema": sch, "name": tbl, "columns": []})
-            t["columns"].append({"name": col, "type": typ})
+    # Server-side cursor: rows arrive in batches instead of being buffered all at once
+    with engine.connect().execution_options(stream_results=True, yield_per=1000) as c:
+        for sch, tbl, cols in c.execute(q):
+            if isinstance(cols, (str, bytes)):  # drivers without a json type adapter
+                cols = loads(cols)
+            out[f"{sch}.{tbl}"] = {"schema": sch, "name": tbl, "columns": cols}
     return out
 
 
 def load_dsns():
-    # handle BOM
-    with open(DSNS_FILE, "r", encoding="utf-8-sig") as f:
-        return json.load(f)
+    # BOM-aware, parsed with orjson when available
+    return load_json_with_encoding(DSNS_FILE)
 
-def main():
-    dsns = load_dsns()
-    catalog = {}
-    for db_id, dsn in dsns.items():
+def introspect_one(db_id, dsn):
+    """Catalog entry for one database; connection errors are recorded, not raised"""
+    try:
+        eng = create_engine(dsn, pool_pre_ping=True, future=True)
         try:
-            eng = create_engine(dsn, pool_pre_ping=True, future=True)
             tables = list_tables_cols(eng)
-            catalog[db_id] = {"db_id": db_id, "tables": tables}
-        except Exception as e:
-            catalog[db_id] = {"db_id": db_id, "error": str(e), "tables": {}}
+        finally:
+            eng.dispose()
+        return {"db_id": db_id, "tables": tables}
+    except Exception as e:
+        return {"db_id": db_id, "error": str(e), "tables": {}}
+
+def main():
+    dsns = load_dsns()
+    # Introspect all databases concurrently; wallclock is the slowest DB rather than the sum
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(dsns)))) as ex:
+        entries = list(ex.map(introspect_one, dsns.keys(), dsns.values()))
+    catalog = {entry["db_id"]: entry for entry in entries}
+    
+    # Encode once; the same bytes go to the file and to stdout
+    catalog_bytes = dump_json_bytes(catalog)
     
     # Save catalog to file first
-    with open("data/catalog_live.json", "w", encoding="utf-8") as f:
-        json.dump(catalog, f, indent=2, ensure_ascii=False)
+    atomic_write_bytes("data/catalog_live.json", catalog_bytes)
     print("Basic catalog saved to data/catalog_live.json", file=sys.stderr)
     
     # Enhance with descriptions and generate tag mappings
@@ -52,8 +67,9 @@ def main():
     generate_field_tag_mappings()
     
     # Also write to stdout for backward compatibility
-    catalog_json = json.dumps(catalog, ensure_ascii=False, indent=2)
-    sys.stdout.write(catalog_json)
+    sys.stdout.flush()
+    sys.stdout.buffer.write(catalog_bytes)
+    sys.stdout.buffer.flush()
 
 
 def enhance_catalog_with_descriptions():
@@ -69,9 +85,10 @@ def enhance_catalog_with_descriptions():
             
         print("Adding field descriptions to catalog...", file=sys.stderr)
         from app.field_descriptor import add_field_descriptions_to_catalog
+        # Freshly introspected columns have no descriptions; unchanged ones come back from the cache
         add_field_descriptions_to_catalog(
             catalog_file="data/catalog_live.json",
-            force_regenerate=True
+            force_regenerate=False
         )
         print("Field descriptions added to catalog!", file=sys.stderr)
     except Exception as e:
@@ -0,0 +1,124 @@
+# app/json_io.py
+"""
+JSON file loading and atomic writes shared by the catalog tools and the UI
+"""
+import json
+import os
+import pathlib
+import threading
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson is in requirements.txt; stdlib json keeps a bare interpreter working
+    orjson = None
+
+# Parse JSON from str or UTF-8 bytes; decode errors are ValueError (json.JSONDecodeError) either way
+loads = orjson.loads if orjson is not None else json.loads
+
+# absolute path -> ((mtime_ns, size) when parsed, parsed JSON) for load_json
+_JSON_CACHE: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+_JSON_CACHE_MAX = 32
+# load_json runs on worker threads too (config and mappings load concurrently); guards _JSON_CACHE updates
+_JSON_CACHE_LOCK = threading.Lock()
+# absolute path -> (parsed DSNs object, read-only lower-cased view of it) for load_dsns
+_DSNS_CACHE: Dict[str, Tuple[Any, Mapping[str, str]]] = {}
+
+def dumps(obj: Any, indent: bool = False, sort_keys: bool = False) -> str:
+    """Serialize obj as a JSON str, compact unless indent is set"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=option).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None, sort_keys=sort_keys)
+
+def dump_json_bytes(obj: Any) -> bytes:
+    """Serialize obj as indented UTF-8 JSON, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+def atomic_write_bytes(path: str, data: bytes) -> None:
+    """
+    Write data to a sibling .tmp file and rename it over path, so readers
+    never see a half-written file. Set CATALOG_DURABLE=1 to fsync before the rename.
+    """
+    path = str(path)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            if os.getenv("CATALOG_DURABLE") == "1":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def atomic_write_json(path: str, obj: Any) -> None:
+    """atomic_write_bytes of obj serialized with dump_json_bytes"""
+    atomic_write_bytes(path, dump_json_bytes(obj))
+
+def _detect_encoding(data: bytes) -> str:
+    """Encoding of a JSON file from its BOM, or from the NUL-byte pattern of BOM-less UTF-16"""
+    if data[:3] == b'\xef\xbb\xbf':
+        return 'utf-8-sig'
+    if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        return 'utf-16'
+    # JSON starts with an ASCII character, so UTF-16 shows a NUL in one byte of the first pair
+    if len(data) >= 2 and data[0] and not data[1]:
+        return 'utf-16-le'
+    if len(data) >= 2 and not data[0] and data[1]:
+        return 'utf-16-be'
+    return 'utf-8'
+
+def load_json_with_encoding(file_path: str) -> Dict[str, Any]:
+    """Load JSON file, decoding it once in the encoding its leading bytes indicate"""
+    p = pathlib.Path(file_path)
+    if not p.exists():
+        raise FileNotFoundError(f"File not found: {file_path}")
+    
+    data = p.read_bytes()
+    enc = _detect_encoding(data)
+    try:
+        # UTF-8 bytes parse directly, without an intermediate str
+        return loads(data if enc == 'utf-8' else data.decode(enc))
+    except ValueError as e:
+        raise ValueError(f"Failed to parse JSON '{file_path}'.") from e
+
+def load_json(file_path: str) -> Dict[str, Any]:
+    """
+    load_json_with_encoding, reusing the parsed result while the file's mtime and size are unchanged.
+    The returned dict is shared between callers and must not be modified.
+    """
+    path = os.path.abspath(file_path)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File not found: {file_path}") from None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    hit = _JSON_CACHE.get(path)
+    if hit is not None and hit[0] == signature:
+        return hit[1]
+    data = load_json_with_encoding(path)
+    with _JSON_CACHE_LOCK:
+        if path not in _JSON_CACHE and len(_JSON_CACHE) >= _JSON_CACHE_MAX:
+            _JSON_CACHE.pop(next(iter(_JSON_CACHE)))
+        _JSON_CACHE[path] = (signature, data)
+    return data
+
+def load_dsns(file_path: str = "dsns.json") -> Mapping[str, str]:
+    """Read-only DSNs keyed by lower-cased db_id, rebuilt only when the file changes"""
+    try:
+        dsns = load_json(file_path)
+    except ValueError as e:
+        raise ValueError(f"Failed to parse DSNs '{file_path}'.") from e
+    path = os.path.abspath(file_path)
+    hit = _DSNS_CACHE.get(path)
+    if hit is not None and hit[0] is dsns:
+        return hit[1]
+    view = MappingProxyType({k.lower(): v for k, v in dsns.items()})
+    _DSNS_CACHE[path] = (dsns, view)
+    return view
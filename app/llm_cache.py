@@ -0,0 +1,134 @@
+# app/llm_cache.py
+"""
+On-disk cache for LLM responses, keyed by a hash of the request
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+DEFAULT_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/.llm_cache.sqlite")
+
+def request_key(*parts: str) -> str:
+    """Stable key for an LLM request from its parts (model, system prompt, user prompt, ...)"""
+    return hashlib.blake2b("\x1f".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+class LLMCache:
+    """
+    SQLite-backed key/value store for raw LLM responses, with an optional TTL; thread-safe.
+    memory_items > 0 keeps that many recent entries in an in-process LRU in front of SQLite.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl_seconds: Optional[float] = None, memory_items: int = 0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.memory_items = memory_items
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("create table if not exists llm_cache (key text primary key, value text not null, created real not null)")
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, value: str, created: float) -> None:
+        if self.memory_items > 0:
+            self._memory[key] = (value, created)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached value for key, or None when missing or older than the TTL"""
+        with self._lock:
+            row = self._memory.get(key)
+            if row is not None:
+                self._memory.move_to_end(key)
+            else:
+                row = self._connect().execute("select value, created from llm_cache where key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._remember(key, row[0], row[1])
+        if row is None:
+            return None
+        value, created = row
+        if self.ttl_seconds is not None and time.time() - created > self.ttl_seconds:
+            return None
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        created = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("insert or replace into llm_cache (key, value, created) values (?, ?, ?)", (key, value, created))
+            conn.commit()
+            self._remember(key, value, created)
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # sentence-transformers is optional; embedding-based features stay disabled without it
+    SentenceTransformer = None
+
+EMBEDDINGS_AVAILABLE = SentenceTransformer is not None
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+def embed_texts(texts: List[str], model_name: str = DEFAULT_EMBEDDING_MODEL):
+    """(len(texts), dim) float32 matrix of unit-length embeddings; each model is loaded once per process"""
+    with _MODELS_LOCK:
+        model = _MODELS.get(model_name)
+        if model is None:
+            model = _MODELS[model_name] = SentenceTransformer(model_name)
+    return model.encode(texts, normalize_embeddings=True).astype(np.float32)
+
+class SemanticCache:
+    """
+    In-process cache of results for near-duplicate natural language queries.
+    A lookup hits when the cosine similarity of the query embeddings is >= threshold
+    and the catalog hash matches; the newest max_items entries are kept.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL, threshold: float = 0.95, max_items: int = 1000):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.max_items = max_items
+        self._embeddings = None  # (n, dim) float32, rows are unit vectors
+        self._entries: List[Tuple[str, str, str]] = []  # (catalog_hash, nl_query, value)
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return EMBEDDINGS_AVAILABLE
+
+    def embed(self, text: str):
+        """Unit-length embedding of text; the model is loaded on first use"""
+        return embed_texts([text], self.model_name)[0]
+
+    def get(self, embedding, catalog_hash: str) -> Optional[str]:
+        with self._lock:
+            if self._embeddings is None:
+                return None
+            scores = self._embeddings @ embedding
+            best = int(scores.argmax())
+            if scores[best] >= self.threshold and self._entries[best][0] == catalog_hash:
+                return self._entries[best][2]
+        return None
+
+    def add(self, embedding, catalog_hash: str, nl_query: str, value: str) -> None:
+        with self._lock:
+            row = embedding[None, :]
+            self._embeddings = row if self._embeddings is None else np.vstack([self._embeddings, row])
+            self._entries.append((catalog_hash, nl_query, value))
+            if len(self._entries) > self.max_items:
+                self._embeddings = self._embeddings[-self.max_items:]
+                self._entries = self._entries[-self.max_items:]
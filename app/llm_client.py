@@ -0,0 +1,107 @@
+# app/llm_client.py
+"""
+OpenAI API helpers shared by the planner and the offline catalog tools
+"""
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import requests
+
+if __package__:
+    from .json_io import dumps, loads
+else:  # imported as a top-level module, e.g. by the planner run from app/
+    from json_io import dumps, loads
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional; a chars/4 estimate is the fallback
+    tiktoken = None
+
+@lru_cache(maxsize=8)
+def _token_encoder(model: str):
+    """tiktoken encoding for model (None without tiktoken)"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text: str, model: str) -> int:
+    """Token count for text under model; ~4 chars per token without tiktoken"""
+    enc = _token_encoder(model)
+    if enc is None:
+        return len(text) // 4 + 1
+    # Catalog and user text may contain special-token strings like <|endoftext|>; count them as plain text
+    return len(enc.encode(text, disallowed_special=()))
+
+def batch_complete(
+    session: requests.Session,
+    endpoint: str,
+    api_key: str,
+    bodies: List[Dict[str, Any]],
+    file_name: str = "batch.jsonl",
+    poll_interval: float = 30.0,
+    verbose: bool = False,
+) -> List[Optional[str]]:
+    """
+    Run chat completion request bodies through the OpenAI Batch API (half price, completes within 24h) and wait for the results.
+    Returns each request's message content in request order; a request that failed yields None.
+    """
+    if not bodies:
+        return []
+    api_base = endpoint.rsplit("/chat/completions", 1)[0]
+    auth = {"Authorization": f"Bearer {api_key}"}
+
+    # One JSONL request line per body, matched back up by custom_id
+    lines = [
+        dumps({"custom_id": f"req-{i}", "method": "POST", "url": "/v1/chat/completions", "body": body})
+        for i, body in enumerate(bodies)
+    ]
+    upload = session.post(
+        f"{api_base}/files",
+        headers=auth,
+        data={"purpose": "batch"},
+        files={"file": (file_name, "\n".join(lines).encode("utf-8"), "application/jsonl")},
+        timeout=(10, 120),
+    )
+    upload.raise_for_status()
+
+    created = session.post(
+        f"{api_base}/batches",
+        headers=auth,
+        json={"input_file_id": upload.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"},
+        timeout=(10, 60),
+    )
+    created.raise_for_status()
+    batch = created.json()
+    if verbose:
+        print(f"Submitted batch {batch['id']} with {len(bodies)} requests; polling every {poll_interval:.0f}s...")
+
+    while batch.get("status") not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        polled = session.get(f"{api_base}/batches/{batch['id']}", headers=auth, timeout=(10, 60))
+        polled.raise_for_status()
+        batch = polled.json()
+        if verbose:
+            counts = batch.get("request_counts") or {}
+            print(f"   - Batch {batch['id']}: {batch.get('status')} ({counts.get('completed', 0)}/{counts.get('total', len(bodies))})")
+
+    if not batch.get("output_file_id"):
+        raise RuntimeError(f"Batch {batch['id']} ended with status '{batch.get('status')}' and no output")
+    output = session.get(f"{api_base}/files/{batch['output_file_id']}/content", headers=auth, timeout=(10, 300))
+    output.raise_for_status()
+
+    by_id: Dict[str, str] = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        item = loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            if verbose:
+                print(f"⚠️  Batch request {item.get('custom_id')} failed: {item.get('error') or response.get('status_code')}")
+            continue
+        by_id[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return [by_id.get(f"req-{i}") for i in range(len(bodies))]
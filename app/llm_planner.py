@@ -6,10 +6,7 @@ def llm_generate_final_sql(nl_query: str, per_db_metadata: dict, openai_api_key:
 
     Returns: {"sql": "..."}
     """
-    import json
     import os
-    import requests
-    import re
 
     # Use provided or default env vars
     openai_api_key = openai_api_key or os.getenv("OPENAI_API_KEY", "").strip()
@@ -51,8 +48,9 @@ Output rules:
 -- Column inclusion guarantee:
 - ALWAYS ensure the final SELECT includes every column in the per-db query's metadata."""
 
-    table_schemas_json = json.dumps(table_schemas, indent=2)
-    print("TABLE SCHEMAS JSON:", table_schemas_json)
+    # Compact, sorted JSON: no whitespace tokens, and the prompt (and its cache key) stays stable when metadata order churns
+    table_schemas_json = dumps(table_schemas, sort_keys=True)
+    logger.debug("TABLE SCHEMAS JSON: %s", table_schemas_json)
 
     USER = f"""
 Natural language request:
@@ -80,6 +78,12 @@ Intersection semantics (default — common rows):
 Return a single SQL statement that answers the request using only the provided tables and columns. Return ONLY the SQL string; if you include any casts add a short inline comment explaining the cast. If you cannot safely produce SQL, return an explicit JSON-like error object (as plain text) explaining the type mismatch or missing columns.
 """
 
+    cache_key = request_key(openai_model, "text", SYSTEM, USER)
+    cached = _LLM_CACHE.get(cache_key) if _CACHE_ENABLED else None
+    if cached is not None:
+        return {"sql": cached}
+
+    _check_context(SYSTEM, USER, openai_model)
     headers = {
         "Authorization": f"Bearer {openai_api_key}",
         "Content-Type": "application/json",
@@ -93,19 +97,83 @@ Return a single SQL statement that answers the request using only the provided t
         ],
         "temperature": 0.1,
     }
-    r = requests.post(llm_endpoint, headers=headers, json=payload, timeout=60)
+    r = _SESSION.post(llm_endpoint, headers=headers, json=payload, timeout=60)
     # Keep the response text for debugging but do not include any row-level data in the request.
-    print("LLM response status:", r.status_code)
+    logger.debug("LLM response status: %s", r.status_code)
     r.raise_for_status()
     data = r.json()
     sql = data["choices"][0]["message"]["content"].strip()
     # Clean up SQL (remove markdown, etc)
-    sql = re.sub(r"^```sql|```$", "", sql, flags=re.I).strip()
+    sql = _SQL_FENCE_RE.sub("", sql).strip()
+    # Error objects and other non-SQL replies are returned but never cached, so a rerun can recover
+    if _CACHE_ENABLED and _SQL_START_RE.match(sql):
+        _LLM_CACHE.set(cache_key, sql)
 
     return {"sql": sql}
 # app/llm_planner.py
-import os, json, re, requests
-from typing import Dict, Any, List
+import os, logging, re, requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple, FrozenSet
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from llm_cache import EMBEDDINGS_AVAILABLE, LLMCache, SemanticCache, embed_texts, request_key
+from llm_client import batch_complete, count_tokens
+from json_io import dumps, loads
+
+try:
+    import re2
+except ImportError:  # google-re2 is optional; stdlib re is the fallback
+    re2 = None
+
+logger = logging.getLogger(__name__)
+
+# Exact-match response cache: identical (model, system, user) requests skip the LLM round trip
+_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+_LLM_CACHE = LLMCache(ttl_seconds=24 * 3600, memory_items=2048)
+# Near-duplicate cache: paraphrased requests against the same catalog reuse an earlier plan
+_SEMANTIC_CACHE = SemanticCache() if os.getenv("SEMANTIC_CACHE", "0") == "1" else None
+# Stream the plan so scope repairs start while the rest of the plan is still being generated
+_STREAM_PLAN = os.getenv("PLANNER_STREAM", "1") != "0"
+# With sentence-transformers installed, only the most relevant tables per DB go into the planner prompt
+# (0 sends every table). Without it nothing is pruned: name overlap misses synonyms like customers/clients.
+_TOP_TABLES = int(os.getenv("PLANNER_TOP_TABLES", "20"))
+_TABLE_EMBEDDINGS: Dict[str, Any] = {}
+_SLIM_TABLES: Dict[int, Tuple[Any, int, Dict[str, Any]]] = {}
+# id(catalog_by_db) -> (catalog, hash of the whole catalog) scoping semantic-cache entries
+_CATALOG_HASHES: Dict[int, Tuple[Any, str]] = {}
+
+# Prompts are sized client-side so an oversized catalog never costs a rejected round trip
+CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS", "128000"))
+RESPONSE_RESERVE_TOKENS = 2048
+# (max_tables, max_cols) tried in order until the planner prompt fits
+_SLIM_SIZES = ((150, 80), (60, 60), (25, 40))
+
+class ContextTooLarge(RuntimeError):
+    """The prompt would not fit in the model's context window"""
+
+    def __init__(self, tokens: int, limit: int):
+        super().__init__(f"Prompt is ~{tokens} tokens; the model context leaves room for {limit}.")
+        self.tokens = tokens
+        self.limit = limit
+
+# One pooled keep-alive session for every LLM call; avoids a TCP+TLS handshake per request
+_SESSION = requests.Session()
+_SESSION.headers.update({"Connection": "keep-alive"})
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"]),
+))
+
+# Compiled once; these run on every plan and final-SQL response.
+# The scope check scans LLM-written SQL, so it uses linear-time RE2 when available.
+_SCOPE_RE = (re2 or re).compile(r'(?i)\b(?:from|join)\s+([a-zA-Z0-9_\."]+)')
+_JSON_TAIL_RE = re.compile(r"\{.*\}\s*$", re.S)
+_SQL_FENCE_RE = re.compile(r"^```sql|```$", re.I)
+_SQL_START_RE = re.compile(r"\s*(?:select|with)\b", re.I)
+_PER_DB_ARRAY_RE = re.compile(r'"per_db_sql"\s*:\s*\[')
+_NAME_RE = re.compile(r"[a-z0-9_.]+")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_MODEL   = os.getenv("OPENAI_MODEL", "gpt-4o").strip()
@@ -194,36 +262,111 @@ Return exactly one JSON object with:
 }}
 """
 
+@lru_cache(maxsize=8)
+def _system_tokens(system: str, model: str) -> int:
+    # System prompts are a few fixed strings; user prompts are almost always unique, so they are counted each time
+    return count_tokens(system, model)
+
+def _check_context(system: str, user: str, model: str) -> None:
+    """Raise ContextTooLarge when system + user leave no room for the response"""
+    limit = CONTEXT_TOKENS - RESPONSE_RESERVE_TOKENS
+    total = _system_tokens(system, model) + count_tokens(user, model)
+    if total > limit:
+        raise ContextTooLarge(total, limit)
+
+def _table_text(fq: str, t: Dict[str, Any]) -> str:
+    names = [c.get("name") if isinstance(c, dict) else str(c) for c in (t.get("columns") or [])]
+    return f"{fq}: {', '.join(n for n in names if n)}"
+
+def _table_embeddings(texts: List[str]):
+    key = request_key(*texts)
+    emb = _TABLE_EMBEDDINGS.get(key)
+    if emb is None:
+        if len(_TABLE_EMBEDDINGS) >= 32:
+            _TABLE_EMBEDDINGS.clear()
+        emb = _TABLE_EMBEDDINGS[key] = embed_texts(texts)
+    return emb
+
+def _relevant_tables(nl_query: str, catalog_by_db: Dict[str, Any], k: int = _TOP_TABLES) -> Dict[str, Any]:
+    """
+    catalog_by_db cut down to the k tables per DB whose embeddings are closest to the request.
+    Tables named in the request are always kept. Without sentence-transformers the catalog is returned as is.
+    """
+    if k <= 0 or not EMBEDDINGS_AVAILABLE:
+        return catalog_by_db
+    q_names = set(_NAME_RE.findall(nl_query.lower()))
+    q_emb = None
+    pruned: Dict[str, Any] = {}
+    for db_id, db in catalog_by_db.items():
+        tmap = db.get("tables") or {}
+        if len(tmap) <= k:
+            pruned[db_id] = db
+            continue
+        names = list(tmap)
+        texts = [_table_text(fq, tmap[fq]) for fq in names]
+        if q_emb is None:
+            q_emb = embed_texts([nl_query])[0]
+        scores = (_table_embeddings(texts) @ q_emb).tolist()
+        mentioned = [fq.lower() in q_names or fq.lower().rsplit(".", 1)[-1] in q_names for fq in names]
+        ranked = sorted(range(len(names)), key=lambda i: (mentioned[i], scores[i]), reverse=True)
+        keep = set(ranked[:k]) | {i for i, m in enumerate(mentioned) if m}
+        pruned[db_id] = {**db, "tables": {fq: tmap[fq] for i, fq in enumerate(names) if i in keep}}
+    return pruned
+
+def _slim_table(t: Dict[str, Any], max_cols: int) -> Dict[str, Any]:
+    # Memoized per table object: the catalog is reused across plans, so each table is slimmed once
+    hit = _SLIM_TABLES.get(id(t))
+    if hit is not None and hit[0] is t and hit[1] == max_cols:
+        return hit[2]
+    cols = t.get("columns") or []
+    skinny = [
+        {"name": c.get("name"), "type": c.get("type")} if isinstance(c, dict) else {"name": str(c)}
+        for c in cols[:max_cols]
+    ]
+    stable = {"columns": skinny}
+    if len(_SLIM_TABLES) >= 50_000:
+        _SLIM_TABLES.clear()
+    _SLIM_TABLES[id(t)] = (t, max_cols, stable)
+    return stable
+
+def _catalog_hash(catalog_by_db: Dict[str, Any]) -> str:
+    # Hash of the full catalog, not the per-query slim one: paraphrases prune to different tables
+    hit = _CATALOG_HASHES.get(id(catalog_by_db))
+    if hit is not None and hit[0] is catalog_by_db:
+        return hit[1]
+    digest = request_key(dumps(catalog_by_db, sort_keys=True))
+    if len(_CATALOG_HASHES) >= 8:
+        _CATALOG_HASHES.clear()
+    _CATALOG_HASHES[id(catalog_by_db)] = (catalog_by_db, digest)
+    return digest
+
 def _slim_catalog(catalog_by_db: Dict[str, Any], max_tables=150, max_cols=80) -> Dict[str, Any]:
     slim: Dict[str, Any] = {}
     for db_id, db in catalog_by_db.items():
         tmap = db.get("tables") or {}
-        stables: Dict[str, Any] = {}
-        for fq, t in list(tmap.items())[:max_tables]:
-            cols = t.get("columns") or []
-            skinny = []
-            for c in cols[:max_cols]:
-                if isinstance(c, dict):
-                    skinny.append({"name": c.get("name"), "type": c.get("type")})
-                else:
-                    skinny.append({"name": str(c)})
-            stables[fq] = {"columns": skinny}
+        stables = {fq: _slim_table(t, max_cols) for fq, t in list(tmap.items())[:max_tables]}
         slim[db_id] = {"tables": stables}
     return slim
 
 def _coerce_json(text: str) -> Dict[str, Any]:
     text = text.strip()
     try:
-        return json.loads(text)
+        return loads(text)
     except Exception:
-        m = re.search(r"\{.*\}\s*$", text, re.S)
+        m = _JSON_TAIL_RE.search(text)
         if m:
-            return json.loads(m.group(0))
+            return loads(m.group(0))
         raise ValueError("Planner LLM did not return valid JSON.")
 
-def _llm_complete(system: str, user: str) -> str:
+def _llm_complete(system: str, user: str) -> Dict[str, Any]:
+    """Parsed JSON reply; only replies that parse are cached"""
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY not set.")
+    cache_key = request_key(OPENAI_MODEL, "json_object", system, user)
+    cached = _LLM_CACHE.get(cache_key) if _CACHE_ENABLED else None
+    if cached is not None:
+        return _coerce_json(cached)
+    _check_context(system, user, OPENAI_MODEL)
     headers = {
         "Authorization": f"Bearer {OPENAI_API_KEY}",
         "Content-Type": "application/json",
@@ -237,74 +380,320 @@ def _llm_complete(system: str, user: str) -> str:
         ],
         "temperature": 0.1,
     }
-    r = requests.post(LLM_ENDPOINT, headers=headers, json=payload, timeout=60)
+    r = _SESSION.post(LLM_ENDPOINT, headers=headers, json=payload, timeout=60)
     r.raise_for_status()
     data = r.json()
-    return data["choices"][0]["message"]["content"]
+    content = data["choices"][0]["message"]["content"]
+    parsed = _coerce_json(content)
+    if _CACHE_ENABLED:
+        _LLM_CACHE.set(cache_key, content)
+    return parsed
 
-def _db_scope_check(db_id: str, sql: str, catalog: Dict[str, Any]) -> bool:
+def _llm_complete_stream(system: str, user: str, on_text) -> Dict[str, Any]:
+    """
+    Like _llm_complete, but streams the response and hands each content delta to on_text as it arrives.
+    Only a complete reply ([DONE] seen, finish_reason "stop") that parses is cached.
+    """
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY not set.")
+    cache_key = request_key(OPENAI_MODEL, "json_object", system, user)
+    cached = _LLM_CACHE.get(cache_key) if _CACHE_ENABLED else None
+    if cached is not None:
+        on_text(cached)
+        return _coerce_json(cached)
+    _check_context(system, user, OPENAI_MODEL)
+    headers = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json",
+    }
+    payload = {
+        "model": OPENAI_MODEL,
+        "response_format": {"type": "json_object"},
+        "messages": [
+            {"role":"system","content":system},
+            {"role":"user","content":user}
+        ],
+        "temperature": 0.1,
+        "stream": True,
+    }
+    parts: List[str] = []
+    done, finish_reason = False, None
+    with _SESSION.post(LLM_ENDPOINT, headers=headers, json=payload, timeout=60, stream=True) as r:
+        r.raise_for_status()
+        r.encoding = "utf-8"  # text/event-stream carries no charset; requests would assume latin-1
+        for line in r.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            chunk = line[5:].strip()
+            if chunk == "[DONE]":
+                done = True
+                break
+            choices = loads(chunk).get("choices") or []
+            if choices and choices[0].get("finish_reason"):
+                finish_reason = choices[0]["finish_reason"]
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if delta:
+                parts.append(delta)
+                on_text(delta)
+    content = "".join(parts)
+    parsed = _coerce_json(content)
+    if _CACHE_ENABLED and done and finish_reason == "stop":
+        _LLM_CACHE.set(cache_key, content)
+    return parsed
+
+class _PerDbItemScanner:
+    """Incrementally picks complete objects out of the "per_db_sql" array of a streaming plan"""
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = -1  # scan position; -1 until the array has been found
+        self.depth = 0
+        self.start = -1
+        self.in_str = False
+        self.escape = False
+        self.done = False
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self.buf += text
+        items: List[Dict[str, Any]] = []
+        if self.done:
+            return items
+        if self.pos < 0:
+            m = _PER_DB_ARRAY_RE.search(self.buf)
+            if not m:
+                return items
+            self.pos = m.end()
+        buf = self.buf
+        for i in range(self.pos, len(buf)):
+            ch = buf[i]
+            if self.in_str:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                self.in_str = True
+            elif ch in "{[":
+                if self.depth == 0:
+                    self.start = i
+                self.depth += 1
+            elif ch in "}]":
+                if self.depth == 0:  # end of the per_db_sql array
+                    self.done = True
+                    break
+                self.depth -= 1
+                if self.depth == 0 and self.start >= 0:
+                    try:
+                        item = loads(buf[self.start:i + 1])
+                        if isinstance(item, dict):
+                            items.append(item)
+                    except ValueError:
+                        pass
+                    self.start = -1
+        self.pos = len(buf)
+        return items
+
+def _scope_sets(slim: Dict[str, Any]) -> Dict[str, FrozenSet[str]]:
+    """Lowercased table names per DB (like 'public.invoices'), built once per plan for _db_scope_check"""
+    return {db_id: frozenset(t.lower() for t in (db.get("tables") or {})) for db_id, db in slim.items()}
+
+def _db_scope_check(tables_lower: FrozenSet[str], sql: str) -> bool:
     """Ensure all FROM/JOIN refs exist in this DB's catalog."""
-    tables = set((catalog[db_id].get("tables") or {}).keys())  # like 'public.invoices'
     def norm(t: str) -> str:
         t = t.replace('"','')
         return t if "." in t else f"public.{t}"
-    refs = set(m.group(1).strip() for m in re.finditer(r'\b(?:from|join)\s+([a-zA-Z0-9_\."]+)', sql, re.I))
-    refs = {norm(r).lower() for r in refs}
-    return refs.issubset({t.lower() for t in tables})
+    refs = {norm(m.group(1).strip()).lower() for m in _SCOPE_RE.finditer(sql)}
+    return refs <= tables_lower
+
+def _plan_candidate(item: Any, scopes: Dict[str, FrozenSet[str]]) -> Any:
+    """Normalized, scope-checked per-db entry, or None when the entry is unusable"""
+    if not isinstance(item, dict):
+        return None
+    db_id = item.get("db_id")
+    sql   = (item.get("sql") or "").strip()
+    purp  = item.get("purpose") or "query"
+    if not db_id or not sql or db_id not in scopes:
+        return None
+    return {"db_id": db_id, "sql": sql, "purpose": purp, "ok": _db_scope_check(scopes[db_id], sql)}
+
+def _repair_sql(db_id: str, sql: str, purp: str, slim: Dict[str, Any], scopes: Dict[str, FrozenSet[str]]) -> str:
+    """Ask the LLM to rewrite an out-of-scope per-db SQL once; "" when the rewrite is still unusable"""
+    fix_user = f"""The following SQL wrongly referenced tables not present in DB '{db_id}'.
 
-def plan(nl_query: str, catalog_by_db: Dict[str, Any]) -> Dict[str, Any]:
-    # 1) build slim catalog for the LLM
-    slim = _slim_catalog(catalog_by_db)
-    user = USER_TEMPLATE.format(nl=nl_query, catalog_json=json.dumps(slim, ensure_ascii=False))
-    raw = _llm_complete(SYSTEM, user)
-    data = _coerce_json(raw)
+DB '{db_id}' tables: {list((slim[db_id]['tables'] or {}).keys())}
+
+Rewrite this SQL to use only tables from DB '{db_id}', keep semantics, and keep LIMIT 10000:
+SQL:
+{sql}
 
+Return JSON:
+{{"db_id":"{db_id}","sql":"...","purpose":"{purp}"}}"""
+    try:
+        fixed = _llm_complete(SYSTEM, fix_user)
+        sql2 = (fixed.get("sql") or "").strip()
+        if sql2 and _db_scope_check(scopes[db_id], sql2):
+            return sql2
+    except Exception:
+        pass
+    return ""
+
+def _planner_prompt(nl_query: str, catalog_by_db: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    """(slim catalog, user prompt) at the largest _SLIM_SIZES that fits the context; ContextTooLarge if none does"""
+    relevant = _relevant_tables(nl_query, catalog_by_db)
+    for max_tables, max_cols in _SLIM_SIZES:
+        slim = _slim_catalog(relevant, max_tables=max_tables, max_cols=max_cols)
+        user = USER_TEMPLATE.format(nl=nl_query, catalog_json=dumps(slim))
+        try:
+            _check_context(SYSTEM, user, OPENAI_MODEL)
+            return slim, user
+        except ContextTooLarge:
+            if (max_tables, max_cols) == _SLIM_SIZES[-1]:
+                raise
+
+def plan(nl_query: str, catalog_by_db: Dict[str, Any]) -> Dict[str, Any]:
+    # 1) build slim catalog for the LLM, shrinking it if the prompt would overflow the context
+    slim, user = _planner_prompt(nl_query, catalog_by_db)
+    semantic = _SEMANTIC_CACHE if _SEMANTIC_CACHE is not None and _SEMANTIC_CACHE.available else None
+    if semantic is not None:
+        catalog_hash = _catalog_hash(catalog_by_db)
+        embedding = semantic.embed(nl_query)
+        cached = semantic.get(embedding, catalog_hash)
+        if cached is not None:
+            return loads(cached)
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        scopes = _scope_sets(slim)
+        submit_repair = _repair_submitter(ex, slim, scopes)
+        if _STREAM_PLAN:
+            scanner = _PerDbItemScanner()
+            streamed_clean = set()
+            def on_text(delta: str) -> None:
+                for item in scanner.feed(delta):
+                    c = _plan_candidate(item, scopes)
+                    if c is None or c["db_id"] in streamed_clean:
+                        continue
+                    if c["ok"]:
+                        streamed_clean.add(c["db_id"])
+                    else:
+                        submit_repair(c)
+            data = _llm_complete_stream(SYSTEM, user, on_text)
+        else:
+            data = _llm_complete(SYSTEM, user)
+        result = _resolve_plan(data, scopes, submit_repair)
+
+    if semantic is not None:
+        semantic.add(embedding, catalog_hash, nl_query, dumps(result))
+    return result
+
+def _repair_submitter(ex: ThreadPoolExecutor, slim: Dict[str, Any], scopes: Dict[str, FrozenSet[str]]):
+    """Submits each distinct out-of-scope rewrite once; out-of-scope rewrites are independent LLM round trips"""
+    repairs: Dict[tuple, Any] = {}
+    def submit_repair(c: Dict[str, Any]):
+        key = (c["db_id"], c["sql"], c["purpose"])
+        if key not in repairs:
+            repairs[key] = ex.submit(_repair_sql, c["db_id"], c["sql"], c["purpose"], slim, scopes)
+        return repairs[key]
+    return submit_repair
+
+def _resolve_plan(data: Dict[str, Any], scopes: Dict[str, FrozenSet[str]], submit_repair) -> Dict[str, Any]:
     # 2) validate & scope-check each per-db SQL; if out of scope, ask LLM to rewrite once
     per_db = data.get("per_db_sql", [])
     if not isinstance(per_db, list):
         raise ValueError("per_db_sql must be a list")
 
-    out_list: List[Dict[str, str]] = []
-    seen_db_ids = set()
+    # Pass 1: usable entries in plan order; a DB's entries after its first in-scope one are never used
+    candidates: List[Dict[str, Any]] = []
+    clean_db_ids = set()
     for item in per_db:
-        if not isinstance(item, dict):
-            continue
-        db_id = item.get("db_id")
-        if not db_id or db_id in seen_db_ids:
+        c = _plan_candidate(item, scopes)
+        if c is None or c["db_id"] in clean_db_ids:
             continue  # skip if already processed this DB
-        sql   = (item.get("sql") or "").strip()
-        purp  = item.get("purpose") or "query"
-        if not sql:
-            continue
-        if db_id not in slim:
-            continue
-        if not _db_scope_check(db_id, sql, slim):
-            fix_user = f"""The following SQL wrongly referenced tables not present in DB '{db_id}'.
+        if c["ok"]:
+            clean_db_ids.add(c["db_id"])
+        candidates.append(c)
 
-DB '{db_id}' tables: {list((slim[db_id]['tables'] or {}).keys())}
+    # Pass 2: collect the rewrites, reusing any already started while the plan streamed
+    pending = [(c, submit_repair(c)) for c in candidates if not c["ok"]]
+    for c, future in pending:
+        sql2 = future.result()
+        c["sql"], c["ok"] = sql2, bool(sql2)
 
-Rewrite this SQL to use only tables from DB '{db_id}', keep semantics, and keep LIMIT 10000:
-SQL:
-{sql}
-
-Return JSON:
-{{"db_id":"{db_id}","sql":"...","purpose":"{purp}"}}"""
-            fixed_raw = _llm_complete(SYSTEM, fix_user)
-            try:
-                fixed = _coerce_json(fixed_raw)
-                sql2 = (fixed.get("sql") or "").strip()
-                if sql2 and _db_scope_check(db_id, sql2, slim):
-                    out_list.append({"db_id": db_id, "sql": sql2, "purpose": purp})
-                    seen_db_ids.add(db_id)
-                    continue
-            except Exception:
-                pass
-            continue
-        out_list.append({"db_id": db_id, "sql": sql, "purpose": purp})
-        seen_db_ids.add(db_id)
+    # Pass 3: first in-scope entry per DB wins, as in plan order
+    out_list: List[Dict[str, str]] = []
+    seen_db_ids = set()
+    for c in candidates:
+        if c["ok"] and c["db_id"] not in seen_db_ids:
+            out_list.append({"db_id": c["db_id"], "sql": c["sql"], "purpose": c["purpose"]})
+            seen_db_ids.add(c["db_id"])
 
     final_sql = data.get("final_sql", "")
     if not isinstance(final_sql, str):
         final_sql = ""
 
     return {"per_db_sql": out_list, "final_sql": final_sql.strip()}
+
+def _batch_complete(system: str, users: List[str], poll_interval: float = 30.0) -> List[Any]:
+    """Planner requests through the OpenAI Batch API; results keep request order and a failed request yields None"""
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY not set.")
+    bodies = [
+        {
+            "model": OPENAI_MODEL,
+            "response_format": {"type": "json_object"},
+            "messages": [
+                {"role":"system","content":system},
+                {"role":"user","content":user}
+            ],
+            "temperature": 0.1,
+        }
+        for user in users
+    ]
+    return batch_complete(_SESSION, LLM_ENDPOINT, OPENAI_API_KEY, bodies, file_name="planner.jsonl", poll_interval=poll_interval)
+
+def plan_batch(nl_queries: List[Tuple[str, Dict[str, Any]]], poll_interval: float = 30.0) -> List[Dict[str, Any]]:
+    """
+    plan() for many (nl_query, catalog_by_db) pairs at once via the Batch API, for bulk offline refreshes.
+    Cached plans are not resubmitted; scope repairs run synchronously afterwards.
+    A request the batch could not answer yields {"error": "..."} in its slot.
+    """
+    # A prompt that cannot be built (e.g. ContextTooLarge) fails only its own slot
+    slims: List[Any] = []
+    users: List[Any] = []
+    errors: Dict[int, str] = {}
+    for i, (nl_query, catalog_by_db) in enumerate(nl_queries):
+        try:
+            slim, user = _planner_prompt(nl_query, catalog_by_db)
+        except ContextTooLarge as e:
+            slim, user = None, None
+            errors[i] = str(e)
+        slims.append(slim)
+        users.append(user)
+    keys = [request_key(OPENAI_MODEL, "json_object", SYSTEM, user) if user is not None else None for user in users]
+    raws = [_LLM_CACHE.get(key) if key is not None and _CACHE_ENABLED else None for key in keys]
+    missing = [i for i, raw in enumerate(raws) if raw is None and i not in errors]
+    if missing:
+        for i, raw in zip(missing, _batch_complete(SYSTEM, [users[i] for i in missing], poll_interval)):
+            raws[i] = raw
+    fresh = set(missing)
+
+    results: List[Dict[str, Any]] = []
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        for i, (raw, slim) in enumerate(zip(raws, slims)):
+            if i in errors:
+                results.append({"error": errors[i]})
+                continue
+            if raw is None:
+                results.append({"error": "Planner batch request failed."})
+                continue
+            try:
+                data = _coerce_json(raw)
+                # Only replies that parse are cached, so a bad one is asked again on the next run
+                if i in fresh and _CACHE_ENABLED:
+                    _LLM_CACHE.set(keys[i], raw)
+                scopes = _scope_sets(slim)
+                results.append(_resolve_plan(data, scopes, _repair_submitter(ex, slim, scopes)))
+            except (ValueError, ContextTooLarge) as e:
+                results.append({"error": str(e)})
+    return results
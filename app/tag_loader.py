@@ -1,21 +1,17 @@
 # app/tag_loader.py
-import json
-import pathlib
-from typing import Dict, List, Any
-
-def load_json_with_encoding(file_path: str) -> Dict[str, Any]:
-    """Load JSON file with multiple encoding attempts"""
-    p = pathlib.Path(file_path)
-    if not p.exists():
-        raise FileNotFoundError(f"File not found: {file_path}")
-    
-    data = p.read_bytes()
-    for enc in ("utf-8", "utf-8-sig", "utf-16", "utf-16-le", "utf-16-be"):
-        try:
-            return json.loads(data.decode(enc))
-        except Exception:
-            continue
-    raise ValueError(f"Failed to parse JSON '{file_path}'.")
+import sys
+from typing import Dict, List, Any, Tuple, FrozenSet
+
+if __package__:
+    from .json_io import load_json
+else:  # imported as a top-level module, e.g. by the Streamlit UI run from app/
+    from json_io import load_json
+
+# table key -> (table tags, column -> column tags | table tags)
+TagIndex = Dict[str, Tuple[FrozenSet[str], Dict[str, FrozenSet[str]]]]
+# id(mappings) -> (mappings, its TagIndex, every tag it uses)
+_TAG_INDEX_CACHE: Dict[int, Tuple[Dict[str, Any], TagIndex, FrozenSet[str]]] = {}
+_EMPTY_TAGS: FrozenSet[str] = frozenset()
 
 def should_regenerate_mappings(
     catalog_file: str = "data/catalog_live.json",
@@ -70,7 +66,7 @@ def load_tag_mappings(
     
     # Load existing mappings or return empty
     try:
-        return load_json_with_encoding(mappings_file)
+        return load_json(mappings_file)
     except FileNotFoundError:
         print(f"Warning: Tag mappings file '{mappings_file}' not found. Using empty mappings.")
         return {"table_mappings": {}}
@@ -78,7 +74,7 @@ def load_tag_mappings(
 def load_masking_config(config_file: str = "data_masking_config.json") -> Dict[str, Any]:
     """Load data masking configuration from JSON file"""
     try:
-        return load_json_with_encoding(config_file)
+        return load_json(config_file)
     except FileNotFoundError:
         print(f"Warning: Masking config file '{config_file}' not found. Using default config.")
         return {
@@ -95,35 +91,59 @@ def get_table_key(db_id: str, table_name: str) -> str:
         table_name = f"public.{table_name}"
     return f"{db_id}.{table_name}"
 
-def get_field_tags(db_id: str, table_name: str, column_name: str, tag_mappings: Dict[str, Any]) -> List[str]:
-    """Get tags for a specific field from tag mappings"""
-    table_key = get_table_key(db_id, table_name)
-    table_mappings = tag_mappings.get("table_mappings", {})
-    
-    if table_key not in table_mappings:
-        return []
-    
-    table_data = table_mappings[table_key]
-    
-    # Get column-specific tags
-    column_tags = table_data.get("column_tags", {}).get(column_name, [])
-    
-    # Get table-level tags (inherited by all columns)
-    table_tags = table_data.get("table_tags", [])
-    
-    # Combine and deduplicate
-    all_tags = list(set(column_tags + table_tags))
-    return all_tags
+def compile_tag_index(tag_mappings: Dict[str, Any]) -> TagIndex:
+    """
+    Resolve every table's table-level and per-column tags into frozensets in one walk.
+    Tag strings are interned, so every set holds the same object for a tag and
+    comparisons against other interned tags short-circuit on identity.
+    """
+    index: TagIndex = {}
+    shared: Dict[FrozenSet[str], FrozenSet[str]] = {}  # identical tag sets share one object
+    for table_key, table_data in tag_mappings.get("table_mappings", {}).items():
+        table_tags = frozenset(map(sys.intern, table_data.get("table_tags", [])))
+        table_tags = shared.setdefault(table_tags, table_tags)
+        column_tags = {}
+        for column, tags in table_data.get("column_tags", {}).items():
+            merged = table_tags.union(map(sys.intern, tags)) if table_tags else frozenset(map(sys.intern, tags))
+            column_tags[column] = shared.setdefault(merged, merged)
+        index[table_key] = (table_tags, column_tags)
+    return index
+
+def _indexed(tag_mappings: Dict[str, Any]) -> Tuple[Dict[str, Any], TagIndex, FrozenSet[str]]:
+    # Built once per mappings object; load_tag_mappings hands out the same object while the file is unchanged
+    cached = _TAG_INDEX_CACHE.get(id(tag_mappings))
+    if cached is not None and cached[0] is tag_mappings:
+        return cached
+    index = compile_tag_index(tag_mappings)
+    # column tags already include their table's tags
+    all_tags = frozenset().union(
+        *(table_tags for table_tags, _ in index.values()),
+        *(tags for _, column_tags in index.values() for tags in column_tags.values()),
+    )
+    _TAG_INDEX_CACHE.clear()
+    entry = _TAG_INDEX_CACHE[id(tag_mappings)] = (tag_mappings, index, all_tags)
+    return entry
+
+def _tag_index(tag_mappings: Dict[str, Any]) -> TagIndex:
+    return _indexed(tag_mappings)[1]
+
+def get_field_tags(db_id: str, table_name: str, column_name: str, tag_mappings: Dict[str, Any]) -> FrozenSet[str]:
+    """
+    Get tags for a specific field from tag mappings (column tags plus inherited table tags).
+    The frozenset comes straight from the tag index and is shared; no copy is made per call.
+    """
+    entry = _tag_index(tag_mappings).get(get_table_key(db_id, table_name))
+    if entry is None:
+        return _EMPTY_TAGS
+    table_tags, column_tags = entry
+    return column_tags.get(column_name, table_tags)
 
 def get_table_tags(db_id: str, table_name: str, tag_mappings: Dict[str, Any]) -> List[str]:
     """Get tags for a specific table"""
-    table_key = get_table_key(db_id, table_name)
-    table_mappings = tag_mappings.get("table_mappings", {})
-    
-    if table_key not in table_mappings:
+    entry = _tag_index(tag_mappings).get(get_table_key(db_id, table_name))
+    if entry is None:
         return []
-    
-    return table_mappings[table_key].get("table_tags", [])
+    return sorted(entry[0])
 
 
 
@@ -131,26 +151,15 @@ def get_table_tags(db_id: str, table_name: str, tag_mappings: Dict[str, Any]) ->
 
 def list_all_tags(tag_mappings: Dict[str, Any]) -> List[str]:
     """Get list of all unique tags used in mappings"""
-    all_tags = set()
-    
-    for table_key, table_data in tag_mappings.get("table_mappings", {}).items():
-        # Add table tags
-        all_tags.update(table_data.get("table_tags", []))
-        
-        # Add column tags
-        for column_tags in table_data.get("column_tags", {}).values():
-            all_tags.update(column_tags)
-    
-    return sorted(list(all_tags))
+    return sorted(_indexed(tag_mappings)[2])
 
 def validate_tag_mappings(tag_mappings: Dict[str, Any], config: Dict[str, Any]) -> List[str]:
     """Validate that all tags in mappings are defined in config"""
     errors = []
     
-    defined_tags = set(config.get("tag_definitions", {}).keys())
-    used_tags = set(list_all_tags(tag_mappings))
-    
-    undefined_tags = used_tags - defined_tags
+    # Membership is checked against the definitions dict itself; only the (few) distinct used tags are walked
+    defined_tags = config.get("tag_definitions", {})
+    undefined_tags = [tag for tag in _indexed(tag_mappings)[2] if tag not in defined_tags]
     if undefined_tags:
         errors.append(f"Tags used in mappings but not defined in config: {sorted(undefined_tags)}")
     
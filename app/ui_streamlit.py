@@ -1,24 +1,56 @@
 # ui_streamlit.py
 
-import os, json, pathlib, streamlit as st
-from typing import Dict, Any, List
+import os, logging, time, streamlit as st
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Any, Tuple
 from dotenv import load_dotenv
-from exec_sql import exec_sql
+from exec_sql import exec_sql, wrap_with_limit
 from llm_planner import plan, llm_generate_final_sql
+from llm_cache import request_key
 import duckdb, pandas as pd
 from data_masking import (
-    mask_dataframe_for_display, 
+    build_role_masker,
     get_role_permissions_summary,
     get_masking_summary
 )
 from tag_loader import load_tag_mappings, load_masking_config
+from json_io import load_json, load_dsns
+
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow is optional; DuckDB scans the DataFrames directly without it
+    pa = None
 
 # Load environment variables from .env file
 load_dotenv()
+
+# Debug diagnostics (frames, tag sets); off unless logging is configured at DEBUG
+logger = logging.getLogger(__name__)
+
+# Optional cap on rows fetched per DB, pushed down to the source as a LIMIT. Off (0) by default:
+# the per-DB frames feed the cross-DB join/aggregate, which must see every extracted row.
+PER_DB_ROW_LIMIT = int(os.getenv("PER_DB_ROW_LIMIT", "0"))
+# Per-DB results remembered per session (LRU), keyed on DSN, SQL and row limit.
+# Entries expire after SQL_CACHE_TTL seconds so source changes show up; 0 turns the cache off.
+SQL_CACHE_ITEMS = 64
+SQL_CACHE_TTL = int(os.getenv("SQL_CACHE_TTL", "300"))
+
+# Copy-on-write lets masking return views/shared columns safely (always on from pandas 3)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
 def handle_query(nl_query: str, catalog_by_db: Dict[str, Any]) -> Dict[str, Any]:
     """Thin wrapper so ask.py / UI both call the same entrypoint."""
     return plan(nl_query, catalog_by_db)
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def handle_query_cached(nl_query: str, catalog_path: str, catalog_version: Tuple[int, int]) -> Dict[str, Any]:
+    """handle_query on the catalog file; catalog_version (mtime_ns, size) keys the cache so an edited catalog misses"""
+    return handle_query(nl_query, load_json(catalog_path))
+
 
 
 st.set_page_config(
@@ -28,7 +60,9 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# Force Light Theme and Navigation Bar CSS
+# Force Light Theme and Navigation Bar CSS, plus the favicon script, as a single element.
+# Streamlit drops elements a rerun does not emit again, so this cannot be skipped after the first run;
+# one element instead of two halves what every rerun sends.
 st.markdown("""
 <style>
     /* Remove default Streamlit padding for navigation bar */
@@ -53,7 +87,7 @@ st.markdown("""
     }
     
     /* Button styling - this definitely works */
-    .stButton > button {
+    .stButton > button, .stFormSubmitButton > button {
         background-color: #007BFF !important;
         color: #FFFFFF !important;
         border: none;
@@ -61,7 +95,7 @@ st.markdown("""
         font-weight: 500;
     }
     
-    .stButton > button:hover {
+    .stButton > button:hover, .stFormSubmitButton > button:hover {
         background-color: #0056B3 !important;
     }
     
@@ -79,10 +113,8 @@ st.markdown("""
     }
 
 </style>
-""", unsafe_allow_html=True)
 
-# Custom favicon injection
-st.markdown("""
+<!-- Custom favicon injection -->
 <script>
     // Function to update favicon
     function updateFavicon() {
@@ -110,29 +142,53 @@ st.markdown("""
 </script>
 """, unsafe_allow_html=True)
 
-def load_json(fp: str) -> Dict[str, Any]:
-    p = pathlib.Path(fp)
-    data = p.read_bytes()
-    for enc in ("utf-8", "utf-8-sig", "utf-16", "utf-16-le", "utf-16-be"):
-        try:
-            return json.loads(data.decode(enc))
-        except Exception:
-            pass
-    raise ValueError(f"Failed to parse JSON '{fp}'.")
+@st.cache_resource
+def _duckdb() -> duckdb.DuckDBPyConnection:
+    """Process-wide in-memory DuckDB; each run registers its frames on its own cursor"""
+    con = duckdb.connect(":memory:")
+    con.execute(f"SET threads TO {os.cpu_count() or 1}")
+    if os.getenv("DUCKDB_MEMORY_LIMIT"):
+        con.execute(f"SET memory_limit = '{os.environ['DUCKDB_MEMORY_LIMIT']}'")
+    return con
 
 
-def load_dsns(fp: str="dsns.json") -> Dict[str, str]:
-    p = pathlib.Path(fp)
-    data = p.read_bytes()
-    for enc in ("utf-8", "utf-8-sig", "utf-16", "utf-16-le", "utf-16-be"):
+def _duckdb_source(df: pd.DataFrame):
+    # DuckDB scans Arrow tables natively; the pandas scan has to inspect object columns row by row
+    if pa is not None:
         try:
-            j = json.loads(data.decode(enc))
-            return {k.lower(): v for k,v in j.items()}
-        except Exception:
-            pass
-    raise ValueError(f"Failed to parse DSNs '{fp}'.")
+            return pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass  # mixed-type object columns; let DuckDB's pandas scan handle them
+    return df
+
+
+def _register_views(con: duckdb.DuckDBPyConnection, frames: Dict[str, pd.DataFrame]) -> None:
+    # One transaction for all the views instead of an implicit one per register call; rolled back if any fails
+    con.execute("BEGIN TRANSACTION")
+    try:
+        for name, df in frames.items():
+            con.register(name, _duckdb_source(df))
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
 
 
+def _duckdb_result(con: duckdb.DuckDBPyConnection, sql: str) -> pd.DataFrame:
+    # Arrow-backed columns come straight from DuckDB's Arrow output, without a copy into NumPy blocks
+    result = con.execute(sql)
+    if pa is None:
+        return result.df()
+    table = result.to_arrow_table() if hasattr(result, "to_arrow_table") else result.fetch_arrow_table()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _show_rows(df: pd.DataFrame, limit: int = 200) -> None:
+    # Only the first rows go to the browser; the full frame still feeds DuckDB
+    st.dataframe(df.head(limit), use_container_width=True)
+    if len(df) > limit:
+        st.caption(f"Showing the first {limit} of {len(df)} rows")
+
 
 # Navigation Bar with Logo
 st.markdown("""
@@ -213,11 +269,15 @@ role = st.selectbox(
 
 # Load masking configuration and show role permissions
 try:
-    config = load_masking_config()
-    
-    # Auto-generate field tag mappings if needed (when catalog is newer)
-    with st.spinner("🔍 Checking field tag mappings..."):
-        tag_mappings = load_tag_mappings(catalog_file=catalog_path, auto_generate=True)
+    # The config and the mappings are independent files, so they are read concurrently
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        config_future = ex.submit(load_masking_config)
+
+        # Auto-generate field tag mappings if needed (when catalog is newer)
+        with st.spinner("🔍 Checking field tag mappings..."):
+            mappings_future = ex.submit(load_tag_mappings, catalog_file=catalog_path, auto_generate=True)
+            config = config_future.result()
+            tag_mappings = mappings_future.result()
     
     if role != "admin":
         permissions = get_role_permissions_summary(role, config)
@@ -241,10 +301,10 @@ try:
             
             # for desc in unique_descriptions:
             #     st.write(f"- {desc}")
-            print(f"SENSITIVE TAGS for role {role}: {sensitive_tags}")
+            logger.debug("SENSITIVE TAGS for role %s: %s", role, sensitive_tags)
 
         else:
-            print(f"No sensitive tags for role {role}")
+            logger.debug("No sensitive tags for role %s", role)
             # st.write("**Full access to all data**")
     else:
         st.write("**Administrator - Full Access**")
@@ -257,48 +317,102 @@ except Exception as e:
 
 # Main query input
 st.markdown("<h4>Natural Language Query</h4>", unsafe_allow_html=True)
-query = st.text_input("Enter your query", "Show me the details of all the clients, projects, tasks and invoices.")
+# In a form, editing the query doesn't rerun the script; only submitting does
+with st.form("query_form", border=False):
+    query = st.text_input("Enter your query", "Show me the details of all the clients, projects, tasks and invoices.")
+    submitted = st.form_submit_button("Run")
 
-if st.button("Run"):
+if submitted:
     try:
         catalog = load_json(catalog_path)
         dsns    = load_dsns("dsns.json")
     except Exception as e:
         st.error(f"Load error: {e}")
     else:
-        logical = handle_query(query, catalog)
+        catalog_stat = os.stat(catalog_path)
+        logical = handle_query_cached(query, catalog_path, (catalog_stat.st_mtime_ns, catalog_stat.st_size))
         per     = logical.get("per_db_sql", [])
         final   = logical.get("final_sql", "")
 
         st.subheader("Per-DB SQL")
-        for item in per:
+        # Side by side, up to three per row, so the SQL doesn't push the results below the fold
+        sql_cols = st.columns(min(len(per), 3)) if per else []
+        for i, item in enumerate(per):
             db_id = item.get("db_id")
             sql   = item.get("sql", "").strip()
-            st.markdown(f"**[{db_id}]**")
-            st.code(sql, language="sql")
+            with sql_cols[i % len(sql_cols)]:
+                st.markdown(f"**[{db_id}]**")
+                st.code(sql, language="sql")
 
         st.subheader("Per-DB Results")
-        exec_results=[]
+        jobs = []
         for item in per:
             db_id = item.get("db_id")
             sql   = item.get("sql", "").strip()
             dsn   = dsns.get((db_id or "").lower())
-            if not dsn:
+            jobs.append((db_id, sql, dsn))
+
+        # Per-DB queries hit independent databases, so run them concurrently;
+        # results are still rendered on the script thread, in plan order, each as soon as it is ready
+        # Sub-queries this session already ran come from its result cache instead of the database
+        sql_cache = st.session_state.setdefault("_sql_results", OrderedDict())
+        ex = ThreadPoolExecutor(max_workers=max(1, min(8, len(jobs))))
+        futures, cache_keys, cached_ages = [], [], []
+        now = time.time()
+        for _, sql, dsn in jobs:
+            key = request_key(dsn, sql, str(PER_DB_ROW_LIMIT)) if dsn and SQL_CACHE_TTL > 0 else None
+            entry = sql_cache.get(key) if key else None
+            if entry is not None and now - entry[0] > SQL_CACHE_TTL:
+                del sql_cache[key]
+                entry = None
+            if entry is not None:
+                sql_cache.move_to_end(key)
+                fut = Future()
+                fut.set_result(entry[1])
+                key = None  # nothing to store afterwards
+                cached_ages.append(now - entry[0])
+            else:
+                fut = ex.submit(exec_sql, dsn, sql, PER_DB_ROW_LIMIT or None) if dsn else None
+                cached_ages.append(None)
+            futures.append(fut)
+            cache_keys.append(key)
+        ex.shutdown(wait=False)  # submitted queries still run to completion
+
+        masker = None
+        if config and tag_mappings and role != "admin":
+            # One masker per role and loaded config/mappings, kept across reruns of this session
+            masker_key = (role, id(tag_mappings), id(config))
+            cached = st.session_state.get("_role_masker")
+            if cached is None or cached[0] != masker_key:
+                cached = st.session_state["_role_masker"] = (masker_key, build_role_masker(role, tag_mappings, config))
+            masker = cached[1]
+
+        exec_results=[]
+        for (db_id, sql, dsn), fut, key, cached_age in zip(jobs, futures, cache_keys, cached_ages):
+            if fut is None:
                 st.error(f"DSN not found for '{db_id}'")
                 continue
-            res = exec_sql(dsn, sql)
+            res = fut.result()
+            if cached_age is not None:
+                st.caption(f"[{db_id}] Cached result from {cached_age:.0f}s ago (SQL_CACHE_TTL={SQL_CACHE_TTL}s)")
+            if key is not None and not res["error"]:
+                sql_cache[key] = (time.time(), res)
+                while len(sql_cache) > SQL_CACHE_ITEMS:
+                    sql_cache.popitem(last=False)
             if res["error"]:
                 st.error(f"[{db_id}] {res['error']}")
             else:
                 # Always build a DataFrame with explicit columns so headers are preserved even when there are 0 rows
-                df = pd.DataFrame(res["rows"], columns=res["columns"])
+                df = pd.DataFrame(res["data"], columns=res["columns"], copy=False)
+                if PER_DB_ROW_LIMIT and len(df) >= PER_DB_ROW_LIMIT:
+                    st.caption(f"[{db_id}] Result capped at {PER_DB_ROW_LIMIT} rows (PER_DB_ROW_LIMIT)")
                 
                 # Apply role-based masking to per-DB results
-                if config and tag_mappings and role != "admin":
-                    masked_df, masking_indicators = mask_dataframe_for_display(
-                        df, db_id, None, role, tag_mappings, config
-                    )
+                if masker is not None:
+                    masked_df, masking_indicators = masker(df, db_id)
                     
+                    logger.debug("Applied masking to %s: %d columns masked", db_id, len(masking_indicators))
+
                     # Display with masking indicators
                     st.caption(f"[{db_id}] {len(masked_df)} rows (Role: {role})")
                     if masking_indicators:
@@ -307,7 +421,7 @@ if st.button("Run"):
                         if summary['star_masked_columns'] > 0:
                             st.caption(f"Data Masking Applied: {summary['star_masked_columns']} columns masked")
                     
-                    st.dataframe(masked_df, use_container_width=True)
+                    _show_rows(masked_df)
                     
                     # Show masking details in expander
                     if masking_indicators:
@@ -316,46 +430,23 @@ if st.button("Run"):
                                 st.write(f"**{col}**: {indicator}")
                 else:
                     # Admin or no masking config - show full data
+                    masked_df, masking_indicators = df, {}
                     st.caption(f"[{db_id}] {len(df)} rows")
-                    st.dataframe(df, use_container_width=True)
+                    _show_rows(df)
                 
-                exec_results.append({"db_id":db_id, "columns":res["columns"], "rows":res["rows"]})
+                # The masked frame shown here is the one DuckDB gets, so final results inherit the masking
+                exec_results.append((db_id, masked_df, masking_indicators))
 
         st.subheader("Final Output (in-memory tables)")
         per_db_dfs = {}
 
-        # Build and sanitize DataFrames for each DB
         per_db_masking_info = {}  # Track masking applied to each DB
-        
-        for item in exec_results:
-            db_id = item["db_id"]
-            df = pd.DataFrame(item["rows"], columns=item["columns"])
-
-            # Sanitize common textual NULL sentinels
-            # df = df.replace({"NULL": None, "null": None, "(NULL)": None})
-
-            # Try to coerce object columns that look numeric into numeric dtype
-            # for c in df.columns:
-            #     if df[c].dtype == object:
-            #         coerced = pd.to_numeric(df[c], errors="coerce")
-            #         if coerced.notna().sum() > 0:
-            #             df[c] = coerced
-
-            # Apply masking to per-DB DataFrames BEFORE DuckDB processing
-            # This ensures final results inherit the masking automatically
-            if config and tag_mappings and role != "admin":
-                masked_df, masking_indicators = mask_dataframe_for_display(
-                    df, db_id, None, role, tag_mappings, config
-                )
-                per_db_dfs[db_id] = masked_df
-                per_db_masking_info[db_id] = masking_indicators
-                print(f"Applied masking to {db_id}: {len(masking_indicators)} columns masked")
-            else:
-                per_db_dfs[db_id] = df
-                per_db_masking_info[db_id] = {}
+        for db_id, masked_df, masking_indicators in exec_results:
+            per_db_dfs[db_id] = masked_df
+            per_db_masking_info[db_id] = masking_indicators
                 
-        print(f"PER DB DFS: {per_db_dfs}")
-        print("END PER DB DFS\n")
+        # Formatting the frames is the expensive part, so it only happens when DEBUG is on
+        logger.debug("PER DB DFS: %s", per_db_dfs)
 
         if not per_db_dfs:
             st.info("No per-DB results available to generate a final SQL.")
@@ -382,79 +473,83 @@ if st.button("Run"):
             st.dataframe(single_df.head(200), use_container_width=True)
 
         else:
-            # Register DataFrames into DuckDB
-            con = duckdb.connect()
-            for db_id, df in per_db_dfs.items():
-                con.register(db_id, df)
-
-            # Derive metadata from DuckDB (preferred) with fallback to DataFrame dtypes
-            per_db_metadata = {}
-            for db_id in per_db_dfs.keys():
-                cols = []
-                try:
-                    info_df = con.execute(f"PRAGMA table_info('{db_id}')").df()
-                    if 'name' in info_df.columns and 'type' in info_df.columns:
-                        cols = [f"{row['name']} {row['type']}" for _, row in info_df.iterrows()]
-                    elif 'column_name' in info_df.columns and 'column_type' in info_df.columns:
-                        cols = [f"{row['column_name']} {row['column_type']}" for _, row in info_df.iterrows()]
-                    else:
-                        cols = [f"{c} {str(per_db_dfs[db_id][c].dtype)}" for c in per_db_dfs[db_id].columns]
-                except Exception:
-                    cols = [f"{c} {str(per_db_dfs[db_id][c].dtype)}" for c in per_db_dfs[db_id].columns]
-                per_db_metadata[db_id] = {"columns": cols}
-
-            # Call LLM with metadata-only and execute returned SQL locally
+            # Register DataFrames into DuckDB, on a private cursor of the shared connection
+            con = _duckdb().cursor()
             try:
-                final_plan = llm_generate_final_sql(query, per_db_metadata)
-                sql_used = final_plan.get("sql", "")
-                st.markdown("**Final SQL Statement:**")
-                st.code(sql_used, language="sql")
+                try:
+                    _register_views(con, per_db_dfs)
+                except Exception as e:
+                    st.error(f"Could not load the per-DB results into DuckDB: {e}")
+                    st.stop()
 
+                # Derive metadata from DuckDB (preferred) with fallback to DataFrame dtypes
+                # One information_schema query covers every registered table
                 try:
-                    df_result = con.execute(sql_used).df()
-                    print(f"FINAL RESULT DF: {df_result}")
-                    # If DuckDB returned no columns, derive column names from per-db DataFrame metadata
-                    if df_result is None:
-                        df_result = pd.DataFrame()
-                    if len(df_result.columns) == 0:
-                        # Try intersection of column names across per-db dfs (intersection is default merge behavior)
-                        try:
-                            all_cols = [list(d.columns) for d in per_db_dfs.values()]
-                            if all_cols:
-                                common = set(all_cols[0])
-                                for cols in all_cols[1:]:
-                                    common &= set(cols)
-                                if common:
-                                    df_result = pd.DataFrame(columns=list(common))
+                    rows = con.execute(
+                        "SELECT table_name, column_name, data_type FROM information_schema.columns "
+                        "WHERE table_name IN (SELECT unnest(?)) ORDER BY table_name, ordinal_position",
+                        [list(per_db_dfs)],
+                    ).fetchall()
+                except Exception:
+                    rows = []
+                duck_cols = {
+                    table: [f"{name} {dtype}" for _, name, dtype in group]
+                    for table, group in groupby(rows, key=itemgetter(0))
+                }
+                per_db_metadata = {}
+                for db_id, df in per_db_dfs.items():
+                    cols = duck_cols.get(db_id) or [f"{c} {str(df[c].dtype)}" for c in df.columns]
+                    per_db_metadata[db_id] = {"columns": cols}
+
+                # Call LLM with metadata-only and execute returned SQL locally
+                try:
+                    final_plan = llm_generate_final_sql(query, per_db_metadata)
+                    sql_used = final_plan.get("sql", "")
+                    st.markdown("**Final SQL Statement:**")
+                    st.code(sql_used, language="sql")
+
+                    try:
+                        # Only 200 rows are shown; an outer LIMIT lets DuckDB stop producing rows there
+                        df_result = _duckdb_result(con, wrap_with_limit(sql_used, 200) or sql_used)
+                        logger.debug("FINAL RESULT DF: %s", df_result)
+                        # If DuckDB returned no columns, derive column names from per-db DataFrame metadata
+                        if df_result is None:
+                            df_result = pd.DataFrame()
+                        if len(df_result.columns) == 0:
+                            # Try intersection of column names across per-db dfs (intersection is default merge behavior)
+                            try:
+                                all_cols = [list(d.columns) for d in per_db_dfs.values()]
+                                if all_cols:
+                                    common = set(all_cols[0]).intersection(*all_cols[1:])
+                                    if common:
+                                        df_result = pd.DataFrame(columns=list(common))
+                                    else:
+                                        # fallback: union of all columns, in first-seen order
+                                        union = list(dict.fromkeys(c for cols in all_cols for c in cols))
+                                        df_result = pd.DataFrame(columns=union)
                                 else:
-                                    # fallback: union of all columns
-                                    union = []
-                                    for cols in all_cols:
-                                        for c in cols:
-                                            if c not in union:
-                                                union.append(c)
-                                    df_result = pd.DataFrame(columns=union)
-                            else:
+                                    df_result = pd.DataFrame()
+                            except Exception:
                                 df_result = pd.DataFrame()
-                        except Exception:
-                            df_result = pd.DataFrame()
                     
-                    # Data is already masked from per-DB processing, just display it
-                    if role != "admin" and any(per_db_masking_info.values()):
-                        # Show masking summary from per-DB processing
-                        total_masked_columns = sum(len(indicators) for indicators in per_db_masking_info.values())
-                        if total_masked_columns > 0:
-                            # st.caption(f"Final Combined Result: Data inherits masking from source databases (Role: {role})")
+                        # Data is already masked from per-DB processing, just display it
+                        if role != "admin" and any(per_db_masking_info.values()):
+                            # Show masking summary from per-DB processing
+                            total_masked_columns = sum(len(indicators) for indicators in per_db_masking_info.values())
+                            if total_masked_columns > 0:
+                                # st.caption(f"Final Combined Result: Data inherits masking from source databases (Role: {role})")
                             
-                            with st.expander("Source Database Masking Details"):
-                                for db_id, indicators in per_db_masking_info.items():
-                                    if indicators:
-                                        st.write(f"**{db_id}:**")
-                                        for col, indicator in indicators.items():
-                                            st.write(f"  - {col}: {indicator}")
+                                with st.expander("Source Database Masking Details"):
+                                    for db_id, indicators in per_db_masking_info.items():
+                                        if indicators:
+                                            st.write(f"**{db_id}:**")
+                                            for col, indicator in indicators.items():
+                                                st.write(f"  - {col}: {indicator}")
                     
-                    st.dataframe(df_result.head(200), use_container_width=True)
+                        st.dataframe(df_result.head(200), use_container_width=True)
+                    except Exception as e:
+                        st.error(f"DuckDB execution failed: {e}")
                 except Exception as e:
-                    st.error(f"DuckDB execution failed: {e}")
-            except Exception as e:
-                st.error(f"Failed to generate final SQL from metadata: {e}")
+                    st.error(f"Failed to generate final SQL from metadata: {e}")
+            finally:
+                con.close()